@@ -1,5 +1,4 @@
 """Rail generators (infrastructure manager, "Infrastrukturbetreiber")."""
-import copy
 import sys
 import warnings
 from typing import Callable, Tuple, Optional, Dict, List
@@ -10,13 +9,14 @@ from numpy.random.mtrand import RandomState
 from flatland.core.grid.grid4 import Grid4TransitionsEnum
 from flatland.core.grid.grid4_utils import get_direction, mirror, direction_to_point
 from flatland.core.grid.grid_utils import Vec2dOperations as Vec2d
-from flatland.core.grid.grid_utils import distance_on_rail, IntVector2DArray, IntVector2D, \
-    Vec2dOperations
+from flatland.core.grid.grid_utils import distance_on_rail, IntVector2DArray, IntVector2D
 from flatland.core.grid.rail_env_grid import RailEnvTransitions
 from flatland.core.transition_map import GridTransitionMap
 from flatland.envs.grid4_generators_utils import connect_rail_in_grid_map, connect_straight_line_in_grid_map, \
-    fix_inner_nodes, align_cell_to_city
+    fix_inner_nodes
 from flatland.envs import persistence
+from flatland.envs.rail_generators import _GRID4_DIRECTIONS, _CellMask, _closest_connection_point, \
+    _directions_from_differences
 from flatland.utils.simple_rail import make_custom_rail
 from flatland.utils.simple_rail import make_double_track
 
@@ -29,6 +29,73 @@ RailGeneratorProduct = Tuple[GridTransitionMap, Optional[Dict]]
 RailGenerator = Callable[[int, int, int, int], RailGeneratorProduct]
 
 
+# Bits of a cell transition that move out of the cell in each direction NESW, for any orientation of the agent
+_MOVE_OUT_BITS = (0x8888, 0x4444, 0x2222, 0x1111)
+
+
+def _invalid_cells_mask(grid_map: GridTransitionMap) -> np.ndarray:
+    """
+    Boolean mask of all the cells of the grid for which grid_map.cell_neighbours_valid(cell, True) is False
+    """
+    grid = grid_map.grid.astype(np.int32)
+    height, width = grid.shape
+    invalid = ~np.isin(grid, list(grid_map.transitions.transitions_all))
+    # cells outside the grid have no transitions
+    padded = np.zeros((height + 2, width + 2), dtype=np.int32)
+    padded[1:-1, 1:-1] = grid
+    for direction, (row_step, col_step) in enumerate(grid_map.transitions.gDir2dRC):
+        neighbours = padded[1 + row_step:1 + row_step + height, 1 + col_step:1 + col_step + width]
+        # every direction the cell leads to needs a neighbour that can be left when entered facing that direction
+        moves_out = (grid & _MOVE_OUT_BITS[direction]) != 0
+        neighbour_enterable = ((neighbours >> ((3 - direction) * 4)) & 0xF) != 0
+        invalid |= moves_out & ~neighbour_enterable
+        # an empty cell must not be led to by any neighbour
+        invalid |= (grid == 0) & ((neighbours & _MOVE_OUT_BITS[(direction + 2) % 4]) != 0)
+    return invalid
+
+
+def _connect_points(grid_map: GridTransitionMap, start: IntVector2D, end: IntVector2D,
+                    rail_trans: RailEnvTransitions, forbidden_cells, all_paths: List[IntVector2D]):
+    """
+    Draws a rail avoiding existing rails and the forbidden cells from start to end and adds its cells to all_paths.
+    Warns if the rail could not be drawn or does not connect the two points.
+    """
+    new_line = connect_rail_in_grid_map(grid_map, start, end, rail_trans, flip_start_node_trans=False,
+                                        flip_end_node_trans=False, respect_transition_validity=False,
+                                        avoid_rail=True, forbidden_cells=forbidden_cells)
+    if len(new_line) == 0:
+        warnings.warn("[WARNING] No line added between stations")
+    elif new_line[-1] != end or new_line[0] != start:
+        warnings.warn("[WARNING] Unable to connect requested stations")
+    all_paths.extend(new_line)
+
+
+def _connect_parallel_lines_in_grid_map(grid_map: GridTransitionMap, starts: IntVector2DArray, ends: IntVector2DArray,
+                                        rail_trans: RailEnvTransitions) -> List[IntVector2DArray]:
+    """
+    Same as connect_straight_line_in_grid_map for each pair of start and end cells, but sets the transitions of all
+    the lines at once. All the lines have to run in the same direction.
+    """
+    direction = direction_to_point(starts[0], ends[0])
+    straight_transition = rail_trans.set_transition(0, direction, direction, 1)
+    straight_transition = rail_trans.set_transition(straight_transition, mirror(direction), mirror(direction), 1)
+    paths = []
+    line_rows = []
+    line_cols = []
+    for start, end in zip(starts, ends):
+        if direction % 2 == 0:
+            rows = np.arange(min(start[0], end[0]), max(start[0], end[0]) + 1)
+            cols = np.repeat(start[1], len(rows))
+        else:
+            cols = np.arange(min(start[1], end[1]), max(start[1], end[1]) + 1)
+            rows = np.repeat(start[0], len(cols))
+        paths.append(list(zip(rows, cols)))
+        line_rows.append(rows)
+        line_cols.append(cols)
+    grid_map.grid[np.concatenate(line_rows), np.concatenate(line_cols)] |= straight_transition
+    return paths
+
+
 class RailGen(object):
     """ Base class for RailGen(erator) replacement
 
@@ -364,22 +431,23 @@ class SparseRailGen(RailGen):
 
         city_positions: IntVector2DArray = []
 
-        # We track a grid of allowed indexes that can be sampled from for creating a new city
+        # We track the allowed indexes that can be sampled from for creating a new city
         # This removes the old sampling method of retrying a random sample on failure
-        allowed_grid = np.zeros((height, width), dtype=np.uint8)
         city_radius_pad1 = city_radius + 1
         # Borders have to be not allowed from the start
-        # allowed_grid == 1 indicates locations that are allowed
-        allowed_grid[city_radius_pad1:-city_radius_pad1, city_radius_pad1:-city_radius_pad1] = 1
+        # The allowed indexes are kept in row-major order, blocked indexes are removed from them
+        rows = np.arange(city_radius_pad1, height - city_radius_pad1)
+        cols = np.arange(city_radius_pad1, width - city_radius_pad1)
+        allowed_rows = np.repeat(rows, len(cols))
+        allowed_cols = np.tile(cols, len(rows))
         for _ in range(num_cities):
-            allowed_indexes = np.where(allowed_grid == 1)
-            num_allowed_points = len(allowed_indexes[0])
+            num_allowed_points = len(allowed_rows)
             if num_allowed_points == 0:
                 break
             # Sample one of the allowed indexes
             point_index = np_random.randint(num_allowed_points)
-            row = int(allowed_indexes[0][point_index])
-            col = int(allowed_indexes[1][point_index])
+            row = int(allowed_rows[point_index])
+            col = int(allowed_cols[point_index])
 
             # Need to block city radius and extra margin so that next sampling is correct
             # Clipping handles the case for negative indexes being generated
@@ -388,7 +456,15 @@ class SparseRailGen(RailGen):
             row_end = row + 2 * city_radius_pad1 + 1
             col_end = col + 2 * city_radius_pad1 + 1
 
-            allowed_grid[row_start : row_end, col_start : col_end] = 0
+            # Only the allowed indexes in the blocked rows have to be checked, they are contiguous as the rows are
+            # sorted
+            band_start, band_end = np.searchsorted(allowed_rows, (row_start, row_end))
+            band_cols = allowed_cols[band_start:band_end]
+            still_allowed = (band_cols < col_start) | (band_cols >= col_end)
+            allowed_rows = np.concatenate((allowed_rows[:band_start], allowed_rows[band_start:band_end][still_allowed],
+                                           allowed_rows[band_end:]))
+            allowed_cols = np.concatenate((allowed_cols[:band_start], band_cols[still_allowed],
+                                           allowed_cols[band_end:]))
 
             city_positions.append((row, col))
 
@@ -492,10 +568,9 @@ class SparseRailGen(RailGen):
         for city_position in city_positions:
 
             # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
@@ -589,17 +664,14 @@ class SparseRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
-        set_of_connections = []
+        set_of_connections = set()
         for current_city_idx in np.arange(len(city_positions)):
-            closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
             city_position = city_positions[current_city_idx]
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
             closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[1]])
             if not connection_points[current_city_idx][closest_direction]:
                 closest_direction = (closest_direction + 1) % 4
@@ -609,37 +681,29 @@ class SparseRailGen(RailGen):
                 if not connection_points[current_city_idx][second_closest_direction]:
                     second_closest_direction = (closest_direction + 2) % 4
             out_direction = closest_direction
-            connection_points_copy = copy.deepcopy(connection_points)
+            # the connection points of the neighbour that are still free, only these lists get modified
+            neighbour_index_for_connection = closest_neighb_idx[1]
+            neighbour_points = [list(points) for points in connection_points[neighbour_index_for_connection]]
             i = 0
             for city_out_connection_point in connection_points[current_city_idx][out_direction]:
                 if i % 2 == 0:
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points_copy[closest_neighb_idx[1]][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
-                                city_out_connection_point = city_out_connection_point
-                                current_direction = direction
-                                neighbour_index_for_connection = closest_neighb_idx[1]
+                    current_direction, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, neighbour_points)
                     # choose always the first connection point of a neighbour, because the list is ordered, same as the
                     # list of the outer connection point
-                    possible_connection = [current_city_idx, neighbour_index_for_connection]
-                    reversed_possible_connection = [neighbour_index_for_connection, current_city_idx]
-                    city_direction = direction_to_point(city_position, city_out_connection_point)
-                    neighbour_direction = direction_to_point(city_positions[closest_neighb_idx[1]], neighbour_connection_point)
+                    possible_connection = (current_city_idx, neighbour_index_for_connection)
+                    reversed_possible_connection = (neighbour_index_for_connection, current_city_idx)
+                    # outer connection points lie on the border of their side, so that is the direction to them
+                    city_direction = out_direction
+                    neighbour_direction = current_direction
                     if reversed_possible_connection not in set_of_connections:
                         if city_direction + neighbour_direction in [1, 5] or city_direction == neighbour_direction:
-                            neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][1]
-                            next_neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][0]
+                            neighbour_connection_point = neighbour_points[current_direction][1]
+                            next_neighbour_connection_point = neighbour_points[current_direction][0]
                         else:
-                            neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][0]
-                            next_neighbour_connection_point = \
-                                connection_points_copy[closest_neighb_idx[1]][current_direction][1]
-                        connection_points_copy[closest_neighb_idx[1]][current_direction].remove(neighbour_connection_point)
+                            neighbour_connection_point = neighbour_points[current_direction][0]
+                            next_neighbour_connection_point = neighbour_points[current_direction][1]
+                        neighbour_points[current_direction].remove(neighbour_connection_point)
                         last_city_out_connection_point = city_out_connection_point
 
                     else:
@@ -656,92 +720,44 @@ class SparseRailGen(RailGen):
                          (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
                           neighbour_connection_point[1] > last_city_out_connection_point[1])):
 
-                        new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point,
-                                                            next_neighbour_connection_point,
-                                                            rail_trans, flip_start_node_trans=False,
-                                                            flip_end_node_trans=False,
-                                                            respect_transition_validity=False,
-                                                            avoid_rail=True,
-                                                            forbidden_cells=city_cells)
-                        if len(new_line) == 0:
-                            warnings.warn("[WARNING] No line added between stations")
-                        elif new_line[-1] != next_neighbour_connection_point or new_line[
-                            0] != city_out_connection_point:
-                            warnings.warn("[WARNING] Unable to connect requested stations")
-                        all_paths.extend(new_line)
-
-                        new_line = connect_rail_in_grid_map(grid_map, last_city_out_connection_point,
-                                                            neighbour_connection_point,
-                                                            rail_trans, flip_start_node_trans=False,
-                                                            flip_end_node_trans=False,
-                                                            respect_transition_validity=False,
-                                                            avoid_rail=True,
-                                                            forbidden_cells=city_cells)
-                        if len(new_line) == 0:
-                            warnings.warn("[WARNING] No line added between stations")
-                        elif new_line[-1] != neighbour_connection_point or new_line[
-                            0] != last_city_out_connection_point:
-                            warnings.warn("[WARNING] Unable to connect requested stations")
-                        all_paths.extend(new_line)
-                        set_of_connections.append(possible_connection)
+                        _connect_points(grid_map, city_out_connection_point, next_neighbour_connection_point,
+                                        rail_trans, city_mask, all_paths)
+
+                        _connect_points(grid_map, last_city_out_connection_point, neighbour_connection_point,
+                                        rail_trans, city_mask, all_paths)
+                        set_of_connections.add(possible_connection)
                     else:
 
-                        new_line = connect_rail_in_grid_map(grid_map, last_city_out_connection_point, neighbour_connection_point,
-                                                            rail_trans, flip_start_node_trans=False,
-                                                            flip_end_node_trans=False, respect_transition_validity=False,
-                                                            avoid_rail=True,
-                                                            forbidden_cells=city_cells)
-                        if len(new_line) == 0:
-                            warnings.warn("[WARNING] No line added between stations")
-                        elif new_line[-1] != neighbour_connection_point or new_line[0] != last_city_out_connection_point:
-                            warnings.warn("[WARNING] Unable to connect requested stations")
-                        all_paths.extend(new_line)
-                        set_of_connections.append(possible_connection)
-
-                        new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point, next_neighbour_connection_point,
-                                                            rail_trans, flip_start_node_trans=False,
-                                                            flip_end_node_trans=False, respect_transition_validity=False,
-                                                            avoid_rail=True,
-                                                            forbidden_cells=city_cells)
-                        if len(new_line) == 0:
-                            warnings.warn("[WARNING] No line added between stations")
-                        elif new_line[-1] != next_neighbour_connection_point or new_line[0] != city_out_connection_point:
-                            warnings.warn("[WARNING] Unable to connect requested stations")
-                        all_paths.extend(new_line)
+                        _connect_points(grid_map, last_city_out_connection_point, neighbour_connection_point,
+                                        rail_trans, city_mask, all_paths)
+                        set_of_connections.add(possible_connection)
+
+                        _connect_points(grid_map, city_out_connection_point, next_neighbour_connection_point,
+                                        rail_trans, city_mask, all_paths)
                 i += 1
             if closest_direction != second_closest_direction:
                 out_direction = second_closest_direction
-                connection_points_copy = copy.deepcopy(connection_points)
+                # the connection points of the neighbour that are still free, only these lists get modified
+                neighbour_index_for_connection = closest_neighb_idx[2]
+                neighbour_points = [list(points) for points in connection_points[neighbour_index_for_connection]]
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
                     if i % 2 == 0:
-                        min_connection_dist = np.inf
-                        for direction in grid4_directions:
-                            current_points = connection_points_copy[closest_neighb_idx[2]][direction]
-                            for tmp_in_connection_point in current_points:
-                                tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                                      tmp_in_connection_point)
-                                if tmp_dist < min_connection_dist:
-                                    min_connection_dist = tmp_dist
-                                    neighbour_connection_point = tmp_in_connection_point
-                                    city_out_connection_point = city_out_connection_point
-                                    current_direction = direction
-                                    neighbour_index_for_connection = closest_neighb_idx[2]
-
-                        possible_connection = [current_city_idx, neighbour_index_for_connection]
-                        reversed_possible_connection = [neighbour_index_for_connection, current_city_idx]
-                        city_direction = direction_to_point(city_position, city_out_connection_point)
-                        neighbour_direction = direction_to_point(city_positions[closest_neighb_idx[2]], neighbour_connection_point)
+                        current_direction, neighbour_connection_point = \
+                            _closest_connection_point(city_out_connection_point, neighbour_points)
+
+                        possible_connection = (current_city_idx, neighbour_index_for_connection)
+                        reversed_possible_connection = (neighbour_index_for_connection, current_city_idx)
+                        # outer connection points lie on the border of their side, so that is the direction to them
+                        city_direction = out_direction
+                        neighbour_direction = current_direction
                         if reversed_possible_connection not in set_of_connections:
                             if city_direction + neighbour_direction in [1, 5] or city_direction == neighbour_direction:
-                                neighbour_connection_point = \
-                                    connection_points_copy[closest_neighb_idx[2]][current_direction][1]
-                                next_neighbour_connection_point = \
-                                    connection_points_copy[closest_neighb_idx[2]][current_direction][0]
+                                neighbour_connection_point = neighbour_points[current_direction][1]
+                                next_neighbour_connection_point = neighbour_points[current_direction][0]
                             else:
-                                neighbour_connection_point = connection_points_copy[closest_neighb_idx[2]][current_direction][0]
-                                next_neighbour_connection_point = \
-                                connection_points_copy[closest_neighb_idx[2]][current_direction][1]
-                            connection_points_copy[closest_neighb_idx[2]][current_direction].remove(neighbour_connection_point)
+                                neighbour_connection_point = neighbour_points[current_direction][0]
+                                next_neighbour_connection_point = neighbour_points[current_direction][1]
+                            neighbour_points[current_direction].remove(neighbour_connection_point)
                             last_city_out_connection_point = city_out_connection_point
 
                         else:
@@ -758,62 +774,20 @@ class SparseRailGen(RailGen):
                          (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
                           neighbour_connection_point[1] > last_city_out_connection_point[1])):
 
-                            new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point,
-                                                                next_neighbour_connection_point,
-                                                                rail_trans, flip_start_node_trans=False,
-                                                                flip_end_node_trans=False,
-                                                                respect_transition_validity=False,
-                                                                avoid_rail=True,
-                                                                forbidden_cells=city_cells)
-                            if len(new_line) == 0:
-                                warnings.warn("[WARNING] No line added between stations")
-                            elif new_line[-1] != next_neighbour_connection_point or new_line[
-                                0] != city_out_connection_point:
-                                warnings.warn("[WARNING] Unable to connect requested stations")
-                            all_paths.extend(new_line)
-
-                            new_line = connect_rail_in_grid_map(grid_map, last_city_out_connection_point,
-                                                                neighbour_connection_point,
-                                                                rail_trans, flip_start_node_trans=False,
-                                                                flip_end_node_trans=False,
-                                                                respect_transition_validity=False,
-                                                                avoid_rail=True,
-                                                                forbidden_cells=city_cells)
-                            if len(new_line) == 0:
-                                warnings.warn("[WARNING] No line added between stations")
-                            elif new_line[-1] != neighbour_connection_point or new_line[
-                                0] != last_city_out_connection_point:
-                                warnings.warn("[WARNING] Unable to connect requested stations")
-                            all_paths.extend(new_line)
-                            set_of_connections.append(possible_connection)
+                            _connect_points(grid_map, city_out_connection_point, next_neighbour_connection_point,
+                                            rail_trans, city_mask, all_paths)
+
+                            _connect_points(grid_map, last_city_out_connection_point, neighbour_connection_point,
+                                            rail_trans, city_mask, all_paths)
+                            set_of_connections.add(possible_connection)
                         else:
 
-                            new_line = connect_rail_in_grid_map(grid_map, last_city_out_connection_point,
-                                                                neighbour_connection_point,
-                                                                rail_trans, flip_start_node_trans=False,
-                                                                flip_end_node_trans=False,
-                                                                respect_transition_validity=False,
-                                                                avoid_rail=True,
-                                                                forbidden_cells=city_cells)
-                            if len(new_line) == 0:
-                                warnings.warn("[WARNING] No line added between stations")
-                            elif new_line[-1] != neighbour_connection_point or new_line[0] != last_city_out_connection_point:
-                                warnings.warn("[WARNING] Unable to connect requested stations")
-                            all_paths.extend(new_line)
-                            set_of_connections.append(possible_connection)
-
-                            new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point,
-                                                                next_neighbour_connection_point,
-                                                                rail_trans, flip_start_node_trans=False,
-                                                                flip_end_node_trans=False,
-                                                                respect_transition_validity=False,
-                                                                avoid_rail=True,
-                                                                forbidden_cells=city_cells)
-                            if len(new_line) == 0:
-                                warnings.warn("[WARNING] No line added between stations")
-                            elif new_line[-1] != next_neighbour_connection_point or new_line[0] != city_out_connection_point:
-                                warnings.warn("[WARNING] Unable to connect requested stations")
-                            all_paths.extend(new_line)
+                            _connect_points(grid_map, last_city_out_connection_point, neighbour_connection_point,
+                                            rail_trans, city_mask, all_paths)
+                            set_of_connections.add(possible_connection)
+
+                            _connect_points(grid_map, city_out_connection_point, next_neighbour_connection_point,
+                                            rail_trans, city_mask, all_paths)
                     i += 1
         return all_paths
 
@@ -900,11 +874,9 @@ class SparseRailGen(RailGen):
             number_of_out_rails = len(outer_connection_points[current_city][boarder])
             start_idx = int((nr_of_connection_points - number_of_out_rails) / 2)
             # Connect parallel tracks
-            for track_id in range(nr_of_connection_points):
-                source = inner_connection_points[current_city][boarder][track_id]
-                target = inner_connection_points[current_city][opposite_boarder][track_id]
-                current_track = connect_straight_line_in_grid_map(grid_map, source, target, rail_trans)
-                free_rails[current_city].append(current_track)
+            free_rails[current_city] = _connect_parallel_lines_in_grid_map(
+                grid_map, inner_connection_points[current_city][boarder],
+                inner_connection_points[current_city][opposite_boarder], rail_trans)
 
             for track_id in range(nr_of_connection_points):
                 source = inner_connection_points[current_city][boarder][track_id]
@@ -944,14 +916,9 @@ class SparseRailGen(RailGen):
         Returns a List[List[Tuple[IntVector2D, int]]] containing the coordinates of trainstations as well as their
         track number within the city
         """
-        num_cities = len(city_positions)
-        train_stations = [[] for i in range(num_cities)]
-        for current_city in range(len(city_positions)):
-            for track_nbr in range(len(free_rails[current_city])):
-                possible_location = free_rails[current_city][track_nbr][
-                    int(len(free_rails[current_city][track_nbr]) / 2)]
-                train_stations[current_city].append((possible_location, track_nbr))
-        return train_stations
+        # the train station of a track is its middle cell
+        return [[(track[len(track) // 2], track_nbr) for track_nbr, track in enumerate(free_rails[current_city])]
+                for current_city in range(len(city_positions))]
 
     def _fix_transitions(self, city_cells: IntVector2DArray, inter_city_lines: List[IntVector2DArray],
                          grid_map: GridTransitionMap, vector_field):
@@ -973,22 +940,19 @@ class SparseRailGen(RailGen):
 
         """
 
-        # Fix all cities with illegal transition maps
-        rails_to_fix = np.zeros(3 * grid_map.height * grid_map.width * 2, dtype='int')
-        rails_to_fix_cnt = 0
-        cells_to_fix = city_cells + inter_city_lines
-        for cell in cells_to_fix:
-            cell_valid = grid_map.cell_neighbours_valid(cell, True)
-
-            if not cell_valid:
-                rails_to_fix[3 * rails_to_fix_cnt] = cell[0]
-                rails_to_fix[3 * rails_to_fix_cnt + 1] = cell[1]
-                rails_to_fix[3 * rails_to_fix_cnt + 2] = vector_field[cell]
-
-                rails_to_fix_cnt += 1
+        # Fix all cities with illegal transition maps, all cells are checked before any of them gets fixed
+        cells_to_fix = np.array(city_cells + inter_city_lines, dtype=int).reshape(-1, 2)
+        invalid_cells = _invalid_cells_mask(grid_map)
+        height, width = invalid_cells.shape
+        inside = (cells_to_fix >= 0).all(axis=1) & (cells_to_fix[:, 0] < height) & (cells_to_fix[:, 1] < width)
+        to_fix = np.zeros(len(cells_to_fix), dtype=bool)
+        to_fix[inside] = invalid_cells[cells_to_fix[inside, 0], cells_to_fix[inside, 1]]
+        # cells outside the grid are left to the per cell check, which does not wrap around to their neighbours
+        for idx in np.flatnonzero(~inside):
+            to_fix[idx] = not grid_map.cell_neighbours_valid(tuple(cells_to_fix[idx].tolist()), True)
         # Fix all other cells
-        for cell in range(rails_to_fix_cnt):
-            grid_map.fix_transitions((rails_to_fix[3 * cell], rails_to_fix[3 * cell + 1]), rails_to_fix[3 * cell + 2])
+        for cell in map(tuple, cells_to_fix[to_fix].tolist()):
+            grid_map.fix_transitions(cell, int(vector_field[cell]))
 
     def _closest_neighbour_in_grid4_directions(self, current_city_idx: int, city_positions: IntVector2DArray) -> List[int]:
         """
@@ -1005,43 +969,21 @@ class SparseRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
-
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
-    @staticmethod
-    def argsort(seq):
-        """
-        Same as Numpy sort but for lists
-        Parameters
-        ----------
-        seq: List
-            list that we would like to sort from smallest to largest
-
-        Returns
-        -------
-        Returns the sorted list
-
-        """
-        # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-        return sorted(range(len(seq)), key=seq.__getitem__)
-
     def _get_cells_in_city(self, center: IntVector2D, radius: int, city_orientation: int,
                            vector_field: IntVector2DArray) -> IntVector2DArray:
         """
@@ -1074,9 +1016,12 @@ class SparseRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
 
     @staticmethod
@@ -1271,10 +1216,9 @@ class CustomRailGen(RailGen):
         for city_position in city_positions:
 
             # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
@@ -1364,36 +1308,20 @@ class CustomRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
         for current_city_idx in np.arange(len(city_positions)):
             closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
-            for out_direction in grid4_directions:
+            for out_direction in _GRID4_DIRECTIONS:
 
                 neighbour_idx = self.get_closest_neighbour_for_direction(closest_neighbours, out_direction)
 
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
 
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points[neighbour_idx][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
-                    new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point, neighbour_connection_point,
-                                                        rail_trans, flip_start_node_trans=False,
-                                                        flip_end_node_trans=False, respect_transition_validity=False,
-                                                        avoid_rail=True,
-                                                        forbidden_cells=city_cells)
-                    if len(new_line) == 0:
-                        warnings.warn("[WARNING] No line added between stations")
-                    elif new_line[-1] != neighbour_connection_point or new_line[0] != city_out_connection_point:
-                        warnings.warn("[WARNING] Unable to connect requested stations")
-                    all_paths.extend(new_line)
+                    _, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, connection_points[neighbour_idx])
+                    _connect_points(grid_map, city_out_connection_point, neighbour_connection_point,
+                                    rail_trans, city_mask, all_paths)
         return all_paths
 
     def get_closest_neighbour_for_direction(self, closest_neighbours, out_direction):
@@ -1455,22 +1383,19 @@ class CustomRailGen(RailGen):
 
         """
 
-        # Fix all cities with illegal transition maps
-        rails_to_fix = np.zeros(3 * grid_map.height * grid_map.width * 2, dtype='int')
-        rails_to_fix_cnt = 0
-        cells_to_fix = city_cells + inter_city_lines
-        for cell in cells_to_fix:
-            cell_valid = grid_map.cell_neighbours_valid(cell, True)
-
-            if not cell_valid:
-                rails_to_fix[3 * rails_to_fix_cnt] = cell[0]
-                rails_to_fix[3 * rails_to_fix_cnt + 1] = cell[1]
-                rails_to_fix[3 * rails_to_fix_cnt + 2] = vector_field[cell]
-
-                rails_to_fix_cnt += 1
+        # Fix all cities with illegal transition maps, all cells are checked before any of them gets fixed
+        cells_to_fix = np.array(city_cells + inter_city_lines, dtype=int).reshape(-1, 2)
+        invalid_cells = _invalid_cells_mask(grid_map)
+        height, width = invalid_cells.shape
+        inside = (cells_to_fix >= 0).all(axis=1) & (cells_to_fix[:, 0] < height) & (cells_to_fix[:, 1] < width)
+        to_fix = np.zeros(len(cells_to_fix), dtype=bool)
+        to_fix[inside] = invalid_cells[cells_to_fix[inside, 0], cells_to_fix[inside, 1]]
+        # cells outside the grid are left to the per cell check, which does not wrap around to their neighbours
+        for idx in np.flatnonzero(~inside):
+            to_fix[idx] = not grid_map.cell_neighbours_valid(tuple(cells_to_fix[idx].tolist()), True)
         # Fix all other cells
-        for cell in range(rails_to_fix_cnt):
-            grid_map.fix_transitions((rails_to_fix[3 * cell], rails_to_fix[3 * cell + 1]), rails_to_fix[3 * cell + 2])
+        for cell in map(tuple, cells_to_fix[to_fix].tolist()):
+            grid_map.fix_transitions(cell, int(vector_field[cell]))
 
     def _closest_neighbour_in_grid4_directions(self, current_city_idx: int, city_positions: IntVector2DArray) -> List[int]:
         """
@@ -1487,43 +1412,21 @@ class CustomRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
-
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
-    @staticmethod
-    def argsort(seq):
-        """
-        Same as Numpy sort but for lists
-        Parameters
-        ----------
-        seq: List
-            list that we would like to sort from smallest to largest
-
-        Returns
-        -------
-        Returns the sorted list
-
-        """
-        # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-        return sorted(range(len(seq)), key=seq.__getitem__)
-
     def _get_cells_in_city(self, center: IntVector2D, radius: int, city_orientation: int,
                            vector_field: IntVector2DArray) -> IntVector2DArray:
         """
@@ -1556,9 +1459,12 @@ class CustomRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
 
 
@@ -1731,10 +1637,9 @@ class TestRailGen(RailGen):
         for city_position in city_positions:
 
             # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
@@ -1824,36 +1729,20 @@ class TestRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
         for current_city_idx in np.arange(len(city_positions)):
             closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
-            for out_direction in grid4_directions:
+            for out_direction in _GRID4_DIRECTIONS:
 
                 neighbour_idx = self.get_closest_neighbour_for_direction(closest_neighbours, out_direction)
 
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
 
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points[neighbour_idx][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
-                    new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point, neighbour_connection_point,
-                                                        rail_trans, flip_start_node_trans=False,
-                                                        flip_end_node_trans=False, respect_transition_validity=False,
-                                                        avoid_rail=True,
-                                                        forbidden_cells=city_cells)
-                    if len(new_line) == 0:
-                        warnings.warn("[WARNING] No line added between stations")
-                    elif new_line[-1] != neighbour_connection_point or new_line[0] != city_out_connection_point:
-                        warnings.warn("[WARNING] Unable to connect requested stations")
-                    all_paths.extend(new_line)
+                    _, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, connection_points[neighbour_idx])
+                    _connect_points(grid_map, city_out_connection_point, neighbour_connection_point,
+                                    rail_trans, city_mask, all_paths)
         return all_paths
 
     def get_closest_neighbour_for_direction(self, closest_neighbours, out_direction):
@@ -1915,22 +1804,19 @@ class TestRailGen(RailGen):
 
         """
 
-        # Fix all cities with illegal transition maps
-        rails_to_fix = np.zeros(3 * grid_map.height * grid_map.width * 2, dtype='int')
-        rails_to_fix_cnt = 0
-        cells_to_fix = city_cells + inter_city_lines
-        for cell in cells_to_fix:
-            cell_valid = grid_map.cell_neighbours_valid(cell, True)
-
-            if not cell_valid:
-                rails_to_fix[3 * rails_to_fix_cnt] = cell[0]
-                rails_to_fix[3 * rails_to_fix_cnt + 1] = cell[1]
-                rails_to_fix[3 * rails_to_fix_cnt + 2] = vector_field[cell]
-
-                rails_to_fix_cnt += 1
+        # Fix all cities with illegal transition maps, all cells are checked before any of them gets fixed
+        cells_to_fix = np.array(city_cells + inter_city_lines, dtype=int).reshape(-1, 2)
+        invalid_cells = _invalid_cells_mask(grid_map)
+        height, width = invalid_cells.shape
+        inside = (cells_to_fix >= 0).all(axis=1) & (cells_to_fix[:, 0] < height) & (cells_to_fix[:, 1] < width)
+        to_fix = np.zeros(len(cells_to_fix), dtype=bool)
+        to_fix[inside] = invalid_cells[cells_to_fix[inside, 0], cells_to_fix[inside, 1]]
+        # cells outside the grid are left to the per cell check, which does not wrap around to their neighbours
+        for idx in np.flatnonzero(~inside):
+            to_fix[idx] = not grid_map.cell_neighbours_valid(tuple(cells_to_fix[idx].tolist()), True)
         # Fix all other cells
-        for cell in range(rails_to_fix_cnt):
-            grid_map.fix_transitions((rails_to_fix[3 * cell], rails_to_fix[3 * cell + 1]), rails_to_fix[3 * cell + 2])
+        for cell in map(tuple, cells_to_fix[to_fix].tolist()):
+            grid_map.fix_transitions(cell, int(vector_field[cell]))
 
     def _closest_neighbour_in_grid4_directions(self, current_city_idx: int, city_positions: IntVector2DArray) -> List[int]:
         """
@@ -1947,43 +1833,21 @@ class TestRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
-
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
-    @staticmethod
-    def argsort(seq):
-        """
-        Same as Numpy sort but for lists
-        Parameters
-        ----------
-        seq: List
-            list that we would like to sort from smallest to largest
-
-        Returns
-        -------
-        Returns the sorted list
-
-        """
-        # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-        return sorted(range(len(seq)), key=seq.__getitem__)
-
     def _get_cells_in_city(self, center: IntVector2D, radius: int, city_orientation: int,
                            vector_field: IntVector2DArray) -> IntVector2DArray:
         """
@@ -2016,7 +1880,10 @@ class TestRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
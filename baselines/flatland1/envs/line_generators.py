@@ -1,11 +1,15 @@
 """Line generators (railway undertaking, "EVU")."""
+import os
 import warnings
+from functools import lru_cache
+from operator import attrgetter
 from typing import Tuple, List, Callable, Mapping, Optional, Any
 
 import numpy as np
 from numpy.random.mtrand import RandomState
 
 from flatland.core.grid.grid4_utils import get_new_position
+from flatland.core.grid.grid_utils import IntVector2DArray
 from flatland.core.transition_map import GridTransitionMap
 from flatland.envs.agent_utils import EnvAgent
 from flatland.envs.timetable_utils import Line
@@ -33,22 +37,126 @@ def speed_initialization_helper(nb_agents: int, speed_ratio_map: Mapping[float,
     if speed_ratio_map is None:
         return [1.0] * nb_agents
 
-    nb_classes = len(speed_ratio_map.keys())
-    speed_ratio_map_as_list: List[Tuple[float, float]] = list(speed_ratio_map.items())
-    speed_ratios = list(map(lambda t: t[1], speed_ratio_map_as_list))
-    speeds = list(map(lambda t: t[0], speed_ratio_map_as_list))
-    return list(map(lambda index: speeds[index], np_random.choice(nb_classes, nb_agents, p=speed_ratios)))
+    nb_classes = len(speed_ratio_map)
+    speeds = np.fromiter(speed_ratio_map.keys(), dtype=np.float64, count=nb_classes)
+    speed_ratios = np.fromiter(speed_ratio_map.values(), dtype=np.float64, count=nb_classes)
+    return speed_initialization_helper_cached(nb_agents, speeds, speed_ratios, np_random)
+
+
+def speed_initialization_helper_cached(nb_agents: int, speeds: np.ndarray, speed_ratios: np.ndarray,
+                                       np_random: RandomState) -> List[float]:
+    """
+    Same as `speed_initialization_helper`, but takes the speeds and their ratios already converted to arrays.
+
+    Parameters
+    ----------
+    nb_agents : int
+        The number of agents to generate a speed for
+    speeds : np.ndarray
+        The possible speeds
+    speed_ratios : np.ndarray
+        The ratio of appearance of each speed. The ratios must sum up to 1.
+
+    Returns
+    -------
+    List[float]
+        A list of size nb_agents of speeds with the corresponding probabilistic ratios.
+    """
+    return np_random.choice(speeds, nb_agents, p=speed_ratios).tolist()
+
+
+def _station_halves(city1_parity: int, city2_parity: int, dx_positive: bool, dy_positive: bool,
+                    far_apart: bool) -> Tuple[bool, bool, bool, bool]:
+    """
+    Decision tree for the station halves used by a pair of agents travelling between city1 and city2.
+    Returns whether the start in city1, the next target in city1, the target in city2 and the next start in city2
+    lie in the upper half of the stations of their city.
+    """
+    if city1_parity == 0:
+        start_upper1 = not dx_positive
+        if city2_parity == 0:
+            target_upper2 = dx_positive != far_apart
+        else:
+            target_upper2 = dy_positive
+    else:
+        start_upper1 = dy_positive
+        if city2_parity == 1:
+            target_upper2 = dy_positive == far_apart
+        else:
+            target_upper2 = not dx_positive
+    return start_upper1, not start_upper1, target_upper2, not target_upper2
+
+
+# _station_halves for every state (city1_parity, city2_parity, dx_positive, dy_positive, far_apart) encoded as bits
+_STATION_HALVES = np.array([_station_halves(state >> 4 & 1, state >> 3 & 1, bool(state >> 2 & 1),
+                                            bool(state >> 1 & 1), bool(state & 1)) for state in range(32)],
+                           dtype=np.int8)
+
+
+def _choose_station_indices(city1_orientation: np.ndarray, city2_orientation: np.ndarray, dx: np.ndarray,
+                            dy: np.ndarray, half1: np.ndarray, half2: np.ndarray, city_radius: int,
+                            offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Choose the train stations for pairs of agents travelling between city1 and city2. The first agent of a pair
+    travels from city1 to city2, the second one back. Depending on the orientation and relative position of the
+    cities, agents start or end in the lower or upper half of the stations of a city.
+
+    Parameters
+    ----------
+    city1_orientation, city2_orientation : np.ndarray
+        Orientation of the two cities of every pair
+    dx, dy : np.ndarray
+        Position of city2 relative to city1
+    half1, half2 : np.ndarray
+        Half the number of train stations in city1 and city2
+    city_radius : int
+        Cities closer than this along their axis are treated as neighbours
+    offsets : np.ndarray
+        Uniform random numbers in [0, 1) of shape (num_pairs, 4) used to pick a station within a half
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        agent_start_idx, agent_target_idx, next_agent_start_idx, next_agent_target_idx
+    """
+    # Orientations 0 and 2 have even parity, 1 and 3 odd parity
+    city1_parity = city1_orientation & 1
+    city2_parity = city2_orientation & 1
+    far_apart = np.abs(np.where(city1_parity == 0, dx, dy)) > city_radius + 1
+    state = (city1_parity << 4) | (city2_parity << 3) | ((dx > 0) << 2) | ((dy > 0) << 1) | far_apart
+
+    # Pick a random station within the halves given by the dispatch table
+    halves = np.stack([half1, half1, half2, half2], axis=1)
+    indices = _STATION_HALVES[state] * halves + (offsets * halves).astype(int)
+    agent_start_idx, next_agent_target_idx, agent_target_idx, next_agent_start_idx = indices.T
+    return agent_start_idx, agent_target_idx, next_agent_start_idx, next_agent_target_idx
 
 
 class BaseLineGen(object):
     def __init__(self, speed_ratio_map: Mapping[float, float] = None, seed: int = 1):
         self.speed_ratio_map = speed_ratio_map
         self.seed = seed
+        if speed_ratio_map is not None:
+            self._speeds_arr = np.array(list(speed_ratio_map.keys()), dtype=np.float64)
+            self._ratios_arr = np.array(list(speed_ratio_map.values()), dtype=np.float64)
 
     def generate(self, rail: GridTransitionMap, num_agents: int, hints: Any=None, num_resets: int = 0,
         np_random: RandomState = None) -> Line:
         pass
 
+    def _finalize(self, agents_position: IntVector2DArray, agents_target: IntVector2DArray,
+                  agents_direction: List[int], num_agents: int, np_random: RandomState) -> Line:
+        """
+        Draws the agent speeds and assembles the line from the positions, targets and directions of the agents.
+        """
+        if self.speed_ratio_map:
+            speeds = speed_initialization_helper_cached(num_agents, self._speeds_arr, self._ratios_arr, np_random)
+        else:
+            speeds = [1.0] * num_agents
+
+        return Line(agent_positions=agents_position, agent_directions=agents_direction,
+                    agent_targets=agents_target, agent_speeds=speeds)
+
     def __call__(self, *args, **kwargs):
         return self.generate(*args, **kwargs)
 
@@ -67,15 +175,35 @@ class SparseLineGen(BaseLineGen):
     :param seed: Initiate random seed generator
     """
 
-    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
-        feasible_orientations = []
+    def __init__(self, speed_ratio_map: Mapping[float, float] = None, seed: int = 1):
+        super().__init__(speed_ratio_map, seed)
+        self._feasible_orientations_rail = None
+        self._feasible_orientations = None
+
+    def get_feasible_orientations(self, rail: GridTransitionMap) -> Callable:
+        """
+        Returns a memoized check of the orientations from which a path leads from a start to a target cell.
+        The cache is kept as long as the same rail is passed in, so the rail must not be modified in place.
+        """
+        if self._feasible_orientations_rail is not rail:
+            @lru_cache(maxsize=4096)
+            def feasible_orientations(start, target, possible_orientations) -> Tuple[int, ...]:
+                return tuple(orientation for orientation in possible_orientations
+                             if rail.check_path_exists(start, orientation, target))
 
-        for orientation in possible_orientations:
-            if rail.check_path_exists(start[0], orientation, target[0]):
-                feasible_orientations.append(orientation)
+            self._feasible_orientations_rail = rail
+            self._feasible_orientations = feasible_orientations
+        return self._feasible_orientations
 
-        if len(feasible_orientations) > 0:
+    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
+        feasible_orientations = self.get_feasible_orientations(rail)(start[0], target[0],
+                                                                     tuple(possible_orientations))
+
+        # Only draw a random orientation if there is something to choose from
+        if len(feasible_orientations) > 1:
             return np_random.choice(feasible_orientations)
+        elif len(feasible_orientations) == 1:
+            return feasible_orientations[0]
         else:
             return 0
 
@@ -91,135 +219,55 @@ class SparseLineGen(BaseLineGen):
         :return: Returns the generator to the rail constructor
         """
 
-        _runtime_seed = self.seed + num_resets
-
         train_stations = hints['train_stations']
-        city_positions = hints['city_positions']
-        city_orientation = hints['city_orientations']
+        city_positions = np.asarray(hints['city_positions'], dtype=np.int32)
+        city_orientation = np.asarray(hints['city_orientations'], dtype=np.int8)
+        city_num_stations = np.array([len(stations) for stations in train_stations], dtype=int)
         # Place agents and targets within available train stations
-        agents_position = []
-        agents_target = []
-        agents_direction = []
-        if len(city_positions) in range(5):
-            city_radius = 4
-        elif len(city_positions) in range(5, 9):
-            city_radius = 5
-        else:
-            city_radius = 6
-
-        city1, city2 = None, None
-        city1_num_stations, city2_num_stations = None, None
-        city1_possible_orientations, city2_possible_orientations = None, None
+        agents_position = [None] * num_agents
+        agents_target = [None] * num_agents
+        agents_direction = [None] * num_agents
+        num_cities = len(city_positions)
+        city_radius = 4 if num_cities < 5 else (5 if num_cities < 9 else 6)
+
+        # Agents are placed in pairs: Agent 1 : city1 > city2, Agent 2: city2 > city1
+        num_pairs = (num_agents + 1) // 2
+
+        # Draw all random numbers of the line at once: two to select 2 distinct cities for every pair of agents and
+        # four to pick the train stations within these cities
+        draws = np_random.random_sample((num_pairs, 6))
+        city1 = (draws[:, 0] * num_cities).astype(int)
+        city2 = (city1 + 1 + (draws[:, 1] * (num_cities - 1)).astype(int)) % num_cities
+
+        half1 = city_num_stations[city1] // 2
+        half2 = city_num_stations[city2] // 2
+        dx = city_positions[city2, 0] - city_positions[city1, 0]
+        dy = city_positions[city2, 1] - city_positions[city1, 1]
+        agent_start_idx, agent_target_idx, next_agent_start_idx, next_agent_target_idx = \
+            _choose_station_indices(city_orientation[city1], city_orientation[city2], dx, dy, half1, half2,
+                                    city_radius, draws[:, 2:])
 
         for agent_idx in range(num_agents):
-
+            pair = agent_idx // 2
             if (agent_idx % 2 == 0):
-                # Select 2 cities, find their num_stations and possible orientations
-                city_idx = np_random.choice(len(city_positions), 2, replace=False)
-                city1 = city_idx[0]
-                city2 = city_idx[1]
-                city1_num_stations = len(train_stations[city1])
-                city2_num_stations = len(train_stations[city2])
-                city1_possible_orientations = [city_orientation[city1],
-                                                (city_orientation[city1] + 2) % 4]
-                city2_possible_orientations = [city_orientation[city2],
-                                                (city_orientation[city2] + 2) % 4]
-
-                # Agent 1 : city1 > city2, Agent 2: city2 > city1
-                if city_orientation[city1] == 0 or city_orientation[city1] == 2:
-                    if city_positions[city2][0] - city_positions[city1][0] > 0:
-                        agent_start_idx = np_random.randint(0, city1_num_stations//2)
-                        next_agent_target_idx = np_random.randint(0, city1_num_stations//2) + city1_num_stations//2
-                        if city_orientation[city2] == 0 or city_orientation[city2] == 2:
-                            if city_positions[city2][0] - city_positions[city1][0] > city_radius + 1:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations/2) \
-                                                       + city2_num_stations//2
-                            else:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-                    else:
-                        agent_start_idx = np_random.randint(0, city1_num_stations//2) + city1_num_stations//2
-                        next_agent_target_idx = np_random.randint(0, city1_num_stations//2)
-                        if city_orientation[city2] == 0 or city_orientation[city2] == 2:
-                            if city_positions[city2][0] - city_positions[city1][0] < - city_radius - 1:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-                            else:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2) \
-                                                       + city2_num_stations//2
-                    if city_orientation[city2] == 1 or city_orientation[city2] == 3:
-                        if city_positions[city2][1] - city_positions[city1][1] > 0:
-                            agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                            next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-                        else:
-                            agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                            next_agent_start_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                else:
-                    if city_positions[city2][1] - city_positions[city1][1] > 0:
-                        agent_start_idx = np_random.randint(0, city1_num_stations//2) + city1_num_stations//2
-                        next_agent_target_idx = np_random.randint(0, city1_num_stations//2)
-                        if city_orientation[city2] == 1 or city_orientation[city2] == 3:
-                            if city_positions[city2][1] - city_positions[city1][1] > city_radius + 1:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-                            else:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2) \
-                                                       + city2_num_stations//2
-                    else:
-                        agent_start_idx = np_random.randint(0, city1_num_stations//2)
-                        next_agent_target_idx = np_random.randint(0, city1_num_stations//2) + city1_num_stations//2
-                        if city_orientation[city2] == 1 or city_orientation[city2] == 3:
-                            if city_positions[city2][1] - city_positions[city1][1] < - city_radius - 1:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2) \
-                                                       + city2_num_stations//2
-                            else:
-                                agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                                next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-                    if city_orientation[city2] == 0 or city_orientation[city2] == 2:
-                        if city_positions[city2][0] - city_positions[city1][0] > 0:
-                            agent_target_idx = np_random.randint(0, city2_num_stations//2)
-                            next_agent_start_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                        else:
-                            agent_target_idx = np_random.randint(0, city2_num_stations//2) + city2_num_stations//2
-                            next_agent_start_idx = np_random.randint(0, city2_num_stations//2)
-
-                agent_start = train_stations[city1][agent_start_idx]
-                agent_target = train_stations[city2][agent_target_idx]
-                agent_orientation = self.decide_orientation(
-                    rail, agent_start, agent_target, city1_possible_orientations, np_random)
-
+                start_city, target_city = city1[pair], city2[pair]
+                agent_start = train_stations[start_city][agent_start_idx[pair]]
+                agent_target = train_stations[target_city][agent_target_idx[pair]]
             else:
-                agent_start_idx = next_agent_start_idx
-                agent_target_idx = next_agent_target_idx
-
-                agent_start = train_stations[city2][agent_start_idx]
-                agent_target = train_stations[city1][agent_target_idx]
-                agent_orientation = self.decide_orientation(
-                    rail, agent_start, agent_target, city2_possible_orientations, np_random)
+                start_city, target_city = city2[pair], city1[pair]
+                agent_start = train_stations[start_city][next_agent_start_idx[pair]]
+                agent_target = train_stations[target_city][next_agent_target_idx[pair]]
+            start_orientation = int(city_orientation[start_city])
+            possible_orientations = [start_orientation, (start_orientation + 2) % 4]
+            agent_orientation = self.decide_orientation(
+                rail, agent_start, agent_target, possible_orientations, np_random)
 
             # agent1 details
-            agents_position.append((agent_start[0][0], agent_start[0][1]))
-            agents_target.append((agent_target[0][0], agent_target[0][1]))
-            agents_direction.append(agent_orientation)
-
-        if self.speed_ratio_map:
-            speeds = speed_initialization_helper(num_agents, self.speed_ratio_map, seed=_runtime_seed, np_random=np_random)
-        else:
-            speeds = [1.0] * len(agents_position)
+            agents_position[agent_idx] = agent_start[0]
+            agents_target[agent_idx] = agent_target[0]
+            agents_direction[agent_idx] = agent_orientation
 
-        # We add multiply factors to the max number of time steps to simplify task in Flatland challenge.
-        # These factors might change in the future.
-        timedelay_factor = 4
-        alpha = 2
-        max_episode_steps = int(
-            timedelay_factor * alpha * (rail.width + rail.height + num_agents / len(city_positions)))
-
-        return Line(agent_positions=agents_position, agent_directions=agents_direction,
-                        agent_targets=agents_target, agent_speeds=speeds)
+        return self._finalize(agents_position, agents_target, agents_direction, num_agents, np_random)
 
 
 def custom_line_generator(speed_ratio_map: Mapping[float, float] = None, seed: int = 1) -> LineGenerator:
@@ -236,18 +284,33 @@ class CustomLineGen(BaseLineGen):
     :param seed: Initiate random seed generator
     """
 
-    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
-        feasible_orientations = []
+    # (agent_idx % 50 block, route of even agents, route of odd agents), a route being (agent_start, agent_target)
+    _ROUTE_BLOCKS = [
+        (range(0, 16), (((12, 61), 3), ((7, 109), 0)), (((7, 109), 0), ((12, 61), 3))),
+        (range(16, 24), (((7, 61), 0), ((13, 13), 3)), (((13, 13), 3), ((7, 61), 0))),
+        (range(24, 28), (((9, 15), 1), ((7, 61), 0)), (((7, 61), 0), ((8, 15), 0))),
+        (range(28, 36), (((9, 67), 2), ((9, 109), 2)), (((8, 109), 1), ((8, 67), 1))),
+        (range(36, 40), (((13, 13), 3), ((9, 109), 2)), (((8, 109), 1), ((13, 13), 3))),
+        (range(40, 46), (((9, 15), 1), ((9, 109), 2)), (((8, 109), 1), ((8, 15), 0))),
+        (range(46, 48), (((13, 13), 3), ((9, 109), 2)), (((8, 109), 1), ((13, 13), 3))),
+        (range(48, 50), (((9, 15), 1), ((9, 109), 2)), (((8, 109), 1), ((8, 15), 0))),
+    ]
+    # Routes indexed by agent_idx % 50
+    _EVEN_ROUTES = tuple(even_route for block, even_route, _ in _ROUTE_BLOCKS for _ in block)
+    _ODD_ROUTES = tuple(odd_route for block, _, odd_route in _ROUTE_BLOCKS for _ in block)
 
-        if start[0][1] < 23:
+    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
+        start_row, start_column = start[0]
+        if start_column < 23:
             return 1
-        elif start[0][1] > 102:
+        if start_column > 102:
             return 3
-        elif start[0][0] == 7:
+        if start_row == 7:
             return 3
-        elif target[0][1] < 23:
+        target_column = target[0][1]
+        if target_column < 23:
             return 3
-        elif target[0][1] > 102:
+        if target_column > 102:
             return 1
 
     def generate(self, rail: GridTransitionMap, num_agents: int, hints: dict, num_resets: int,
@@ -262,110 +325,52 @@ class CustomLineGen(BaseLineGen):
         :return: Returns the generator to the rail constructor
         """
 
-        _runtime_seed = self.seed + num_resets
-
         train_stations = hints['train_stations']
         city_positions = hints['city_positions']
         city_orientation = hints['city_orientations']
         # Place agents and targets within available train stations
-        agents_position = []
-        agents_target = []
-        agents_direction = []
+        agents_position = [None] * num_agents
+        agents_target = [None] * num_agents
+        agents_direction = [None] * num_agents
 
         city1, city2 = None, None
         city1_num_stations, city2_num_stations = None, None
         city1_possible_orientations, city2_possible_orientations = None, None
 
-        for agent_idx in range(num_agents):
+        # The routes repeat every num_routes agents, so only the first block of agents is computed
+        num_routes = len(self._EVEN_ROUTES)
+        for agent_idx in range(min(num_agents, num_routes)):
 
-            if (agent_idx % 50 in range(16)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((12, 61), 3)
-                    agent_target = ((7, 109), 0)
-                else:
-                    agent_start = ((7, 109), 0)
-                    agent_target = ((12, 61), 3)
-            elif (agent_idx % 50 in range(16, 24)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((7, 61), 0)
-                    agent_target = ((13, 13), 3)
-                else:
-                    agent_start = ((13, 13), 3)
-                    agent_target = ((7, 61), 0)
-            elif (agent_idx % 50 in range(24, 28)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((9, 15), 1)
-                    agent_target = ((7, 61), 0)
-                else:
-                    agent_start = ((7, 61), 0)
-                    agent_target = ((8, 15), 0)
-            elif (agent_idx % 50 in range(28, 36)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((9, 67), 2)
-                    agent_target = ((9, 109), 2)
-                else:
-                    agent_start = ((8, 109), 1)
-                    agent_target = ((8, 67), 1)
-            elif (agent_idx % 50 in range(36, 40)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((13, 13), 3)
-                    agent_target = ((9, 109), 2)
-                else:
-                    agent_start = ((8, 109), 1)
-                    agent_target = ((13, 13), 3)
-            elif (agent_idx % 50 in range(40, 46)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((9, 15), 1)
-                    agent_target = ((9, 109), 2)
-                else:
-                    agent_start = ((8, 109), 1)
-                    agent_target = ((8, 15), 0)
-            elif (agent_idx % 50 in range(46, 48)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((13, 13), 3)
-                    agent_target = ((9, 109), 2)
-                else:
-                    agent_start = ((8, 109), 1)
-                    agent_target = ((13, 13), 3)
-            elif (agent_idx % 50 in range(48, 50)):
-                if (agent_idx % 2 == 0):
-                    agent_start = ((9, 15), 1)
-                    agent_target = ((9, 109), 2)
-                else:
-                    agent_start = ((8, 109), 1)
-                    agent_target = ((8, 15), 0)
+            if agent_idx % 2 == 0:
+                agent_start, agent_target = self._EVEN_ROUTES[agent_idx]
+            else:
+                agent_start, agent_target = self._ODD_ROUTES[agent_idx]
 
             agent_orientation = self.decide_orientation(
                 rail, agent_start, agent_target, [1, 3], np_random)
 
                 # agent1 details
-            agents_position.append((agent_start[0][0], agent_start[0][1]))
-            agents_target.append((agent_target[0][0], agent_target[0][1]))
-            agents_direction.append(agent_orientation)
+            agents_position[agent_idx] = agent_start[0]
+            agents_target[agent_idx] = agent_target[0]
+            agents_direction[agent_idx] = agent_orientation
 
-        if self.speed_ratio_map:
-            speeds = speed_initialization_helper(num_agents, self.speed_ratio_map, seed=_runtime_seed,
-                                                 np_random=np_random)
-        else:
-            speeds = [1.0] * len(agents_position)
-            """
-            uncomment this block to make 16 out of 50 trains drive at 75% of the speed of the rest
-            for i in range(len(agents_position)):
+        for block_start in range(num_routes, num_agents, num_routes):
+            block_end = min(block_start + num_routes, num_agents)
+            agents_position[block_start:block_end] = agents_position[:block_end - block_start]
+            agents_target[block_start:block_end] = agents_target[:block_end - block_start]
+            agents_direction[block_start:block_end] = agents_direction[:block_end - block_start]
+
+        line = self._finalize(agents_position, agents_target, agents_direction, num_agents, np_random)
+        """
+        uncomment this block to make 16 out of 50 trains drive at 75% of the speed of the rest
+        if not self.speed_ratio_map:
+            for i in range(num_agents):
                 if i % 50 in range(16):
-                    speeds[i] = 1/4
+                    line.agent_speeds[i] = 1/4
                 else:
-                    speeds[i] = 1/3
-            """
-
-        # We add multiply factors to the max number of time steps to simplify task in Flatland challenge.
-        # These factors might change in the future.
-        timedelay_factor = 4
-        alpha = 2
-        max_episode_steps = int(
-            timedelay_factor * alpha * (rail.width + rail.height + num_agents / len(city_positions)))
-
-        return Line(agent_positions=agents_position, agent_directions=agents_direction,
-                    agent_targets=agents_target, agent_speeds=speeds)
+                    line.agent_speeds[i] = 1/3
+        """
+        return line
 
 
 def test_line_generator(speed_ratio_map: Mapping[float, float] = None, seed: int = 1) -> LineGenerator:
@@ -382,13 +387,11 @@ class TestLineGen(BaseLineGen):
     :param seed: Initiate random seed generator
     """
 
-    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
-        feasible_orientations = []
+    # Orientation of the agents by the column of their start cell
+    _START_COLUMN_ORIENTATIONS = {1: 1, 16: 3}
 
-        if start[0][1] == 1:
-            return 1
-        elif start[0][1] == 16:
-            return 3
+    def decide_orientation(self, rail, start, target, possible_orientations, np_random: RandomState) -> int:
+        return self._START_COLUMN_ORIENTATIONS.get(start[0][1])
 
     def generate(self, rail: GridTransitionMap, num_agents: int, hints: dict, num_resets: int,
                  np_random: RandomState) -> Line:
@@ -402,15 +405,13 @@ class TestLineGen(BaseLineGen):
         :return: Returns the generator to the rail constructor
         """
 
-        _runtime_seed = self.seed + num_resets
-
         train_stations = hints['train_stations']
         city_positions = hints['city_positions']
         city_orientation = hints['city_orientations']
         # Place agents and targets within available train stations
-        agents_position = []
-        agents_target = []
-        agents_direction = []
+        agents_position = [None] * num_agents
+        agents_target = [None] * num_agents
+        agents_direction = [None] * num_agents
 
         city1, city2 = None, None
         city1_num_stations, city2_num_stations = None, None
@@ -426,33 +427,21 @@ class TestLineGen(BaseLineGen):
             agent_orientation = self.decide_orientation(
                 rail, agent_start, agent_target, [1, 3], np_random)
 
-            agents_position.append((agent_start[0][0], agent_start[0][1]))
-            agents_target.append((agent_target[0][0], agent_target[0][1]))
-            agents_direction.append(agent_orientation)
+            agents_position[agent_idx] = agent_start[0]
+            agents_target[agent_idx] = agent_target[0]
+            agents_direction[agent_idx] = agent_orientation
 
-        if self.speed_ratio_map:
-            speeds = speed_initialization_helper(num_agents, self.speed_ratio_map, seed=_runtime_seed,
-                                                 np_random=np_random)
-        else:
-            speeds = [1.0] * len(agents_position)
-            """
-            uncomment this block to make 16 out of 50 trains drive at 75% of the speed of the rest
-            for i in range(len(agents_position)):
+        line = self._finalize(agents_position, agents_target, agents_direction, num_agents, np_random)
+        """
+        uncomment this block to make 16 out of 50 trains drive at 75% of the speed of the rest
+        if not self.speed_ratio_map:
+            for i in range(num_agents):
                 if i % 50 in range(16):
-                    speeds[i] = 1/4
+                    line.agent_speeds[i] = 1/4
                 else:
-                    speeds[i] = 1/3
-            """
-
-        # We add multiply factors to the max number of time steps to simplify task in Flatland challenge.
-        # These factors might change in the future.
-        timedelay_factor = 4
-        alpha = 2
-        max_episode_steps = int(
-            timedelay_factor * alpha * (rail.width + rail.height + num_agents / len(city_positions)))
-
-        return Line(agent_positions=agents_position, agent_directions=agents_direction,
-                    agent_targets=agents_target, agent_speeds=speeds)
+                    line.agent_speeds[i] = 1/3
+        """
+        return line
 
 
 def line_from_file(filename, load_from_package=None) -> LineGenerator:
@@ -469,28 +458,45 @@ def line_from_file(filename, load_from_package=None) -> LineGenerator:
         initial positions, directions, targets speeds
     """
 
+    # Resolved here rather than at module level: persistence imports this module, so it may not be fully
+    # initialised yet when this module is imported
+    load_env_dict = persistence.RailEnvPersister.load_env_dict
+    # The values of the agents in the file, only reloaded when the file was modified since it was last read
+    agent_values = None
+    loaded_mtime = None
+
     def generator(rail: GridTransitionMap, num_agents: int, hints: Any = None, num_resets: int = 0,
                   np_random: RandomState = None) -> Line:
-
-        env_dict = persistence.RailEnvPersister.load_env_dict(filename, load_from_package=load_from_package)
-
-        max_episode_steps = env_dict.get("max_episode_steps", 0)
-        if (max_episode_steps==0):
-            print("This env file has no max_episode_steps (deprecated) - setting to 100")
-            max_episode_steps = 100
-
-        agents = env_dict["agents"]
-
-        # setup with loaded data
-        agents_position = [a.initial_position for a in agents]
-
-        # this logic is wrong - we should really load the initial_direction as the direction.
-        #agents_direction = [a.direction for a in agents]
-        agents_direction = [a.initial_direction for a in agents]
-        agents_target = [a.target for a in agents]
-        agents_speed = [a.speed_counter.speed for a in agents]
-
-        return Line(agent_positions=agents_position, agent_directions=agents_direction,
-                        agent_targets=agents_target, agent_speeds=agents_speed)
+        nonlocal agent_values, loaded_mtime
+        mtime = None if load_from_package is not None else os.path.getmtime(filename)
+        if agent_values is None or mtime != loaded_mtime:
+            env_dict = load_env_dict(filename, load_from_package=load_from_package)
+
+            max_episode_steps = env_dict.get("max_episode_steps", 0)
+            if (max_episode_steps==0):
+                print("This env file has no max_episode_steps (deprecated) - setting to 100")
+                max_episode_steps = 100
+
+            agents = env_dict["agents"]
+
+            # setup with loaded data
+            # this logic is wrong - we should really load the initial_direction as the direction.
+            #get_agent_line = attrgetter('initial_position', 'direction', 'target', 'speed_counter.speed')
+            get_agent_line = attrgetter('initial_position', 'initial_direction', 'target', 'speed_counter.speed')
+            agents_position, agents_direction, agents_target, agents_speed = [], [], [], []
+            for a in agents:
+                position, direction, target, speed = get_agent_line(a)
+                agents_position.append(position)
+                agents_direction.append(direction)
+                agents_target.append(target)
+                agents_speed.append(speed)
+            agent_values = (tuple(agents_position), tuple(agents_direction), tuple(agents_target),
+                            tuple(agents_speed))
+            loaded_mtime = mtime
+
+        # every reset gets its own lists, the env may modify them
+        agents_position, agents_direction, agents_target, agents_speed = agent_values
+        return Line(agent_positions=list(agents_position), agent_directions=list(agents_direction),
+                    agent_targets=list(agents_target), agent_speeds=list(agents_speed))
 
     return generator
@@ -1,8 +1,10 @@
 """Malfunction generators for rail systems"""
 
-from typing import Callable, NamedTuple, Optional, Tuple
+import math
+from typing import Callable, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
+from numpy.random import Generator
 from numpy.random.mtrand import RandomState
 
 from flatland.envs.agent_utils import EnvAgent
@@ -21,6 +23,11 @@ Malfunction = NamedTuple('Malfunction', [('num_broken_steps', int)])
 # Why is the return value Optional?  We always return a Malfunction.
 MalfunctionGenerator = Callable[[RandomState, bool], Malfunction]
 
+# malfunction durations are drawn from an exponential distribution truncated at this number of steps
+_MAX_NUM_BROKEN_STEPS = 50
+# Malfunction is immutable, so the generators share one instance per duration instead of creating one per call
+_MALFUNCTIONS = tuple(Malfunction(num_broken_steps) for num_broken_steps in range(_MAX_NUM_BROKEN_STEPS + 1))
+
 
 def _malfunction_prob(rate: float) -> float:
     """
@@ -31,7 +38,89 @@ def _malfunction_prob(rate: float) -> float:
     if rate <= 0:
         return 0.
     else:
-        return 1 - np.exp(-rate)
+        return 1 - math.exp(-rate)
+
+
+def _random_sample(np_random: Union[RandomState, Generator], size) -> np.ndarray:
+    """
+    Uniform random numbers in [0, 1) from either a legacy RandomState or a Generator
+    :param np_random:
+    :param size:
+    :return:
+    """
+    if isinstance(np_random, Generator):
+        return np_random.random(size)
+    return np_random.random_sample(size)
+
+
+def _duration_params(expected_delay):
+    """
+    Parameter and probability mass below the truncation of the exponential distribution of malfunction durations
+    with mean 10 * expected_delay, for a single expected delay or an array of them
+    :param expected_delay:
+    :return:
+    """
+    param = 1/(10*expected_delay)
+    return param, 1 - np.exp(-param*_MAX_NUM_BROKEN_STEPS)
+
+
+def _sample_num_broken_steps(param: float, truncated_mass: float, random_number: float) -> int:
+    """
+    Draws a malfunction duration from the truncated exponential distribution given by _duration_params
+    :param param:
+    :param truncated_mass:
+    :param random_number: uniform random number in [0, 1)
+    :return:
+    """
+    # invert the cumulative distribution function of the truncated exponential distribution, the largest duration
+    # whose cumulative probability does not exceed the random number is floor(delay), which gives durations 1 to 50
+    delay = -math.log(1 - random_number*truncated_mass)/param
+    # have a minimum malfunction duration of 2, because a duration of 1 messes up the trajectories
+    return max(2, math.floor(delay) + 1)
+
+
+# departure and running time extensions come in three kinds each, with their probability and expected delay
+_DEPARTURE_MALFUNCTION_PROB = 0.05
+_DEPARTURE_EXPECTED_DELAYS = (0.2, 0.5, 1.)
+# divided by the travel time on the shortest path + 1
+_RUNNING_MALFUNCTION_PROBS = (0.2, 0.5, 0.5)
+_RUNNING_EXPECTED_DELAYS = (1.3, 2., 5.)
+# parameter and truncated mass of the duration distribution by kind, and the probability for running time extensions
+_DEPARTURE_DURATIONS = tuple(tuple(map(float, _duration_params(expected_delay)))
+                             for expected_delay in _DEPARTURE_EXPECTED_DELAYS)
+_RUNNING_DURATIONS = tuple((malfunction_prob,) + tuple(map(float, _duration_params(expected_delay)))
+                           for malfunction_prob, expected_delay in zip(_RUNNING_MALFUNCTION_PROBS,
+                                                                       _RUNNING_EXPECTED_DELAYS))
+
+
+def _compute_num_broken_steps(r0: float, r1: float, r2: float, travel_time: Optional[int]) -> int:
+    """
+    Number of steps an agent is delayed, given three uniform random numbers
+    :param r0: determines the kind of delay
+    :param r1: determines whether the delay occurs
+    :param r2: determines the duration of the delay
+    :param travel_time: travel time on the shortest path of a running agent, None if the agent has not departed yet
+    :return:
+    """
+    if r0 <= 0.48:
+        kind = 0
+    elif r0 <= 0.8:
+        kind = 1
+    else:
+        kind = 2
+    # determine occurrence of departure time extension
+    if travel_time is None:
+        if r1 < _DEPARTURE_MALFUNCTION_PROB:
+            # determine duration of time extension
+            param, truncated_mass = _DEPARTURE_DURATIONS[kind]
+            return _sample_num_broken_steps(param, truncated_mass, r2)
+        return 0
+    # determine occurrence of running time extension
+    malfunction_prob, param, truncated_mass = _RUNNING_DURATIONS[kind]
+    if r1 < malfunction_prob/(travel_time + 1):
+        # determine duration of time extension
+        return _sample_num_broken_steps(param, truncated_mass, r2)
+    return 0
 
 
 class ParamMalfunctionGen(object):
@@ -44,52 +133,35 @@ class ParamMalfunctionGen(object):
         #self.min_number_of_steps_broken = parameters.min_duration
         #self.max_number_of_steps_broken = parameters.max_duration
         self.MFP = parameters
+        # travel times on the shortest path by agent state, for the distance map they were computed with
+        self._travel_time_distances = None
+        self._travel_times = {}
+
+    def _get_travel_time(self, distance_map, agent) -> int:
+        # agents often stay in the same cell for several steps, e.g. while slow, stopped or broken
+        distances = distance_map.get()
+        if distances is not self._travel_time_distances:
+            self._travel_time_distances = distances
+            self._travel_times = {}
+        key = (agent.handle, agent.position, agent.direction, agent.state, agent.target, agent.speed_counter.speed)
+        travel_time = self._travel_times.get(key)
+        if travel_time is None:
+            travel_time = self._travel_times[key] = agent.get_travel_time_on_shortest_path(distance_map)
+        return travel_time
+
+    def generate(self, distance_map, np_random: Union[RandomState, Generator], agent) -> Malfunction:
+        # agents off the map do not malfunction, no need to draw random numbers for them
+        if agent.position is None:
+            return _MALFUNCTIONS[0]
 
-    def generate(self, distance_map, np_random: RandomState, agent) -> Malfunction:
         # draw random numbers to determine occurrence and duration of running and departure time extensions
-        random_array = np_random.random_sample(3)
-        # determine occurrence of departure time extension
+        random_array = _random_sample(np_random, 3)
         if agent.position == agent.initial_position:
-            if 0 <= random_array[0] <= 0.48:
-                malfunction_prob = 0.05
-                expected_delay = 0.2
-            elif 0.48 < random_array[0] <= 0.8:
-                malfunction_prob = 0.05
-                expected_delay = 0.5
-            else:
-                malfunction_prob = 0.05
-                expected_delay = 1
-        # determine occurrence of running time extension
+            travel_time = None
         else:
-            if 0 <= random_array[0] <= 0.48:
-                malfunction_prob = 0.2/(agent.get_travel_time_on_shortest_path(distance_map) + 1)
-                expected_delay = 1.3
-            elif 0.48 < random_array[0] <= 0.8:
-                malfunction_prob = 0.5/(agent.get_travel_time_on_shortest_path(distance_map) + 1)
-                expected_delay = 2
-            else:
-                malfunction_prob = 0.5/(agent.get_travel_time_on_shortest_path(distance_map) + 1)
-                expected_delay = 5
+            travel_time = self._get_travel_time(distance_map, agent)
 
-        if agent.position is None:
-            num_broken_steps = 0
-        # determine duration of time extension
-        elif random_array[1] < malfunction_prob:
-            param = 1/(10*expected_delay)
-            possible_delay_array = np.arange(1, 51)
-            cum_prob_array = np.empty(50)
-            for i in range(50):
-                cum_prob_array[i] = (1 - np.exp(-param*possible_delay_array[i]))/(1-np.exp(-param*possible_delay_array[49]))
-            # have a minimum malfunction duration of 2, because a duration of 1 messes up the trajectories
-            num_broken_steps = 2
-            for i in range(49):
-                if cum_prob_array[i] < random_array[2] < cum_prob_array[i + 1]:
-                    num_broken_steps = i+2
-                    break
-        else:
-            num_broken_steps = 0
-
-        return Malfunction(num_broken_steps)
+        return _MALFUNCTIONS[_compute_num_broken_steps(random_array[0], random_array[1], random_array[2], travel_time)]
 
     def get_process_data(self):
         return MalfunctionProcessData(*self.MFP)
@@ -105,31 +177,23 @@ class TestMalfunctionGen(object):
         #self.min_number_of_steps_broken = parameters.min_duration
         #self.max_number_of_steps_broken = parameters.max_duration
         self.MFP = parameters
+        self._duration_param, self._truncated_mass = _duration_params(expected_delay=2)
 
-    def generate(self, distance_map, np_random: RandomState, agent) -> Malfunction:
+    def generate(self, distance_map, np_random: Union[RandomState, Generator], agent) -> Malfunction:
         malfunction_prob = 0.2/15
-        expected_delay = 2
 
         if agent.position is None:
             num_broken_steps = 0
-        elif np_random.rand() < malfunction_prob:
-            param = 1/(10*expected_delay)
-            possible_delay_array = np.arange(1, 51)
-            cum_prob_array = np.empty(50)
-            for i in range(50):
-                cum_prob_array[i] = (1 - np.exp(-param*possible_delay_array[i]))/(1-np.exp(-param*possible_delay_array[49]))
-            random_number = np_random.rand()
-            # have a minimum malfunction duration of 2, because a duration of 1 messes up the trajectories
-            num_broken_steps = 2
-            for i in range(49):
-                if cum_prob_array[i] < random_number < cum_prob_array[i + 1]:
-                    num_broken_steps = i+2
-                    break
-
         else:
-            num_broken_steps = 0
+            # draw random numbers to determine occurrence and duration of the malfunction
+            random_array = _random_sample(np_random, 2)
+            if random_array[0] < malfunction_prob:
+                num_broken_steps = _sample_num_broken_steps(self._duration_param, self._truncated_mass,
+                                                            random_array[1])
+            else:
+                num_broken_steps = 0
 
-        return Malfunction(num_broken_steps)
+        return _MALFUNCTIONS[num_broken_steps]
 
     def get_process_data(self):
         return MalfunctionProcessData(*self.MFP)
@@ -281,7 +345,10 @@ def malfunction_from_file(filename: str, load_from_package=None) -> Tuple[Malfun
         min_number_of_steps_broken = 0
         max_number_of_steps_broken = 0
 
-    def generator(agent: EnvAgent = None, np_random: RandomState = None, reset=False) -> Optional[Malfunction]:
+    malfunction_prob = _malfunction_prob(mean_malfunction_rate)
+
+    def generator(agent: EnvAgent = None, np_random: Union[RandomState, Generator] = None,
+                  reset=False) -> Optional[Malfunction]:
         """
         Generate malfunctions for agents
         Parameters
@@ -299,9 +366,11 @@ def malfunction_from_file(filename: str, load_from_package=None) -> Tuple[Malfun
             return Malfunction(0)
 
         if agent.malfunction_handler.malfunction_down_counter < 1:
-            if np_random.rand() < _malfunction_prob(mean_malfunction_rate):
-                num_broken_steps = np_random.randint(min_number_of_steps_broken,
-                                                     max_number_of_steps_broken + 1) + 1
+            random_array = _random_sample(np_random, 2)
+            if random_array[0] < malfunction_prob:
+                # uniform duration in [min_number_of_steps_broken, max_number_of_steps_broken], plus one
+                num_broken_steps = min_number_of_steps_broken + int(
+                    random_array[1] * (max_number_of_steps_broken - min_number_of_steps_broken + 1)) + 1
                 return Malfunction(num_broken_steps)
         return Malfunction(0)
 
@@ -331,6 +400,7 @@ def malfunction_from_params(parameters: MalfunctionParameters) -> Tuple[Malfunct
     mean_malfunction_rate = parameters.malfunction_rate
     min_number_of_steps_broken = parameters.min_duration
     max_number_of_steps_broken = parameters.max_duration
+    malfunction_prob = _malfunction_prob(mean_malfunction_rate)
 
     def generator(np_random: RandomState = None, reset=False) -> Optional[Malfunction]:
         """
@@ -349,7 +419,7 @@ def malfunction_from_params(parameters: MalfunctionParameters) -> Tuple[Malfunct
         if reset:
             return Malfunction(0)
 
-        if np_random.rand() < _malfunction_prob(mean_malfunction_rate):
+        if np_random.rand() < malfunction_prob:
             num_broken_steps = np_random.randint(min_number_of_steps_broken,
                                                     max_number_of_steps_broken + 1)
             return Malfunction(num_broken_steps)
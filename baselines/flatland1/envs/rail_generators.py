@@ -1,21 +1,19 @@
 """Rail generators (infrastructure manager, "Infrastrukturbetreiber")."""
-import copy
 import sys
 import warnings
-from typing import Callable, Tuple, Optional, Dict, List
+from typing import Callable, Tuple, Optional, Dict, List, Union
 
 import numpy as np
+from numpy.random import Generator
 from numpy.random.mtrand import RandomState
 
 from flatland.core.grid.grid4 import Grid4TransitionsEnum
 from flatland.core.grid.grid4_utils import get_direction, mirror, direction_to_point
-from flatland.core.grid.grid_utils import Vec2dOperations as Vec2d
-from flatland.core.grid.grid_utils import distance_on_rail, IntVector2DArray, IntVector2D, \
-    Vec2dOperations
+from flatland.core.grid.grid_utils import distance_on_rail, IntVector2DArray, IntVector2D
 from flatland.core.grid.rail_env_grid import RailEnvTransitions
 from flatland.core.transition_map import GridTransitionMap
 from flatland.envs.grid4_generators_utils import connect_rail_in_grid_map, connect_straight_line_in_grid_map, \
-    fix_inner_nodes, align_cell_to_city
+    fix_inner_nodes
 from flatland.envs import persistence
 from flatland1.utils.simple_rail import make_custom_rail
 from flatland1.utils.simple_rail import make_double_track
@@ -28,6 +26,112 @@ RailGeneratorProduct = Tuple[GridTransitionMap, Optional[Dict]]
 
 RailGenerator = Callable[[int, int, int, int], RailGeneratorProduct]
 
+# For each direction NESW, the axis perpendicular to the city border on that side and the sign of the border's offset
+# from the city center along it
+_BORDER_AXIS = (0, 1, 0, 1)
+_BORDER_SIGN = (-1, 1, 1, -1)
+# For each direction NESW of a city border, the sign of the product of the row and column offsets of a neighbour's
+# connection point on the matching diagonal, see _on_matching_diagonal
+_MATCHING_DIAGONAL_SIGN = (-1, -1, 1, 1)
+
+# The transitions are never modified, so all generated grid maps share one instance
+_RAIL_TRANSITIONS = RailEnvTransitions()
+_GRID4_DIRECTIONS = (Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
+                     Grid4TransitionsEnum.WEST)
+
+
+def _random_integers(np_random: Union[RandomState, Generator], low: int, high: int = None) -> int:
+    """
+    Random integer in [low, high), or in [0, low) if high is not given, from either a legacy RandomState or a
+    Generator
+    """
+    if isinstance(np_random, Generator):
+        return int(np_random.integers(low, high))
+    return np_random.randint(low, high)
+
+
+def _directions_from_differences(position_diffs: np.ndarray) -> np.ndarray:
+    """
+    Direction NESW as int given by direction_to_point(pos1, pos2) for each difference pos1 - pos2 along the last axis
+    """
+    # the axis of the larger absolute difference decides, the rows axis on ties
+    along_cols = position_diffs[..., 1] ** 2 > position_diffs[..., 0] ** 2
+    return np.where(along_cols,
+                    np.where(position_diffs[..., 1] > 0, Grid4TransitionsEnum.WEST, Grid4TransitionsEnum.EAST),
+                    np.where(position_diffs[..., 0] > 0, Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.SOUTH))
+
+
+def _closest_neighbour_directions(city_positions: IntVector2DArray, sorted_cities: List[List[int]]) -> List[List[int]]:
+    """
+    Directions from every city to its closest and second closest neighbour, or only to the closest one if there are
+    just two cities
+    """
+    positions = np.asarray(city_positions)
+    closest_neighbours = np.array([sorted_neighbours[1:3] for sorted_neighbours in sorted_cities])
+    return _directions_from_differences(positions[:, np.newaxis] - positions[closest_neighbours]).tolist()
+
+
+def _on_matching_diagonal(direction: int, out_connection_point: IntVector2D,
+                          neighbour_connection_point: IntVector2D) -> bool:
+    """
+    Whether the neighbour's connection point lies diagonally off an outer connection point of a city, on the diagonal
+    matching the border direction of the point. Rows and columns are offset in opposite directions for North and East
+    borders and in the same direction for South and West borders.
+    """
+    row_offset = neighbour_connection_point[0] - out_connection_point[0]
+    col_offset = neighbour_connection_point[1] - out_connection_point[1]
+    return row_offset * col_offset * _MATCHING_DIAGONAL_SIGN[direction] > 0
+
+
+def _closest_connection_point(point: IntVector2D,
+                              connection_points: List[List[IntVector2D]]) -> Tuple[int, IntVector2D]:
+    """
+    Closest connection point of a city to the given point by manhattan distance, together with the direction of the
+    city border it lies on. The first one in order of direction and position is taken among equally close points.
+    """
+    directions = [direction for direction, points in enumerate(connection_points) for _ in points]
+    candidates = [candidate for points in connection_points for candidate in points]
+    closest = int(np.abs(np.array(candidates) - point).sum(axis=1).argmin())
+    return directions[closest], candidates[closest]
+
+
+def _connection_points_on_borders(city_position: IntVector2D, city_radius: int, direction: int,
+                                  connection_slots: np.ndarray, inner_point_offset: np.ndarray, start_idx: int,
+                                  number_of_out_rails: int) -> Tuple[List[List[IntVector2D]], List[List[IntVector2D]]]:
+    """
+    Inner and outer connection points of a city on its border in the given direction and on the opposite border.
+    The points are spread along the borders by their connection slots, the inner points are offset into the city.
+    """
+    # the opposite border lies on the same axis, on the other side of the city center
+    border_axis = _BORDER_AXIS[direction]
+    border_signs = np.array([[_BORDER_SIGN[direction]], [-_BORDER_SIGN[direction]]])
+    inner_coordinates = np.empty((2, len(connection_slots), 2), dtype=int)
+    inner_coordinates[..., border_axis] = city_position[border_axis] + border_signs * (city_radius - inner_point_offset)
+    inner_coordinates[..., 1 - border_axis] = city_position[1 - border_axis] + connection_slots
+    out_coordinates = np.empty((2, number_of_out_rails, 2), dtype=int)
+    out_coordinates[..., border_axis] = city_position[border_axis] + border_signs * city_radius
+    out_coordinates[..., 1 - border_axis] = \
+        city_position[1 - border_axis] + connection_slots[start_idx:start_idx + number_of_out_rails]
+    return ([list(map(tuple, points)) for points in inner_coordinates.tolist()],
+            [list(map(tuple, points)) for points in out_coordinates.tolist()])
+
+
+class _CellMask(object):
+    """
+    Boolean mask of the grid cells in a list of (row, column) coordinates. Supports the membership test a_star does
+    on its forbidden cells with a single array lookup instead of a scan over the list.
+    """
+    __slots__ = ('mask',)
+
+    def __init__(self, height: int, width: int, cells: IntVector2DArray):
+        self.mask = np.zeros((height, width), dtype=bool)
+        if len(cells) > 0:
+            rows, cols = np.array(cells).T
+            self.mask[rows, cols] = True
+
+    def __contains__(self, cell: IntVector2D) -> bool:
+        return bool(self.mask[cell])
+
 
 class RailGen(object):
     """ Base class for RailGen(erator) replacement
@@ -196,7 +300,7 @@ class SparseRailGen(RailGen):
 
 
     def generate(self, width: int, height: int, num_agents: int, num_resets: int = 0,
-                  np_random: RandomState = None) -> RailGenerator:
+                  np_random: Union[RandomState, Generator] = None) -> RailGenerator:
         """
 
         Parameters
@@ -223,9 +327,9 @@ class SparseRailGen(RailGen):
         if self.seed is not None:
             np_random = RandomState(self.seed)
         elif np_random is None:
-            np_random = RandomState(np.random.randint(2**32))
+            np_random = np.random.default_rng(np.random.randint(2**32))
 
-        rail_trans = RailEnvTransitions()
+        rail_trans = _RAIL_TRANSITIONS
         grid_map = GridTransitionMap(width=width, height=height, transitions=rail_trans)
 
         # NEW : SCHED CONST (Pairs of rails (1,2,3 pairs))
@@ -250,6 +354,8 @@ class SparseRailGen(RailGen):
             # sys.exit("[ABORT] Cannot fit more than one city in this map, no feasible environment possible! Aborting.")
             raise ValueError("ERROR: Cannot fit more than one city in this map, no feasible environment possible!")
 
+        # the cities sorted by distance for each city, computed once per set of city positions
+        sorted_cities = None
         # Evenly distribute cities
         if self.grid_mode:
             city_positions = self._generate_evenly_distr_city_positions(max_feasible_cities, city_radius, width,
@@ -261,11 +367,11 @@ class SparseRailGen(RailGen):
             # for large environments check that the cities are not grouped in separate cliques, otherwise find new
             # positions for cities
             if self.max_num_cities > 4:
-                contains_cliques = self.contains_cliques(city_positions)
-                while contains_cliques:
+                sorted_cities = self._sort_cities_by_distance(city_positions)
+                while self.contains_cliques(city_positions, sorted_cities):
                     city_positions = self._generate_random_city_positions(max_feasible_cities, city_radius, width, height,
                                                                       np_random=np_random)
-                    contains_cliques = self.contains_cliques(city_positions)
+                    sorted_cities = self._sort_cities_by_distance(city_positions)
         # reduce num_cities if less were generated in random mode
         num_cities = len(city_positions)
         # If random generation failed just put the cities evenly
@@ -273,16 +379,19 @@ class SparseRailGen(RailGen):
             warnings.warn("[WARNING] Changing to Grid mode to place at least 2 cities.")
             city_positions = self._generate_evenly_distr_city_positions(max_feasible_cities, city_radius, width,
                                                                    height)
+            sorted_cities = None
         num_cities = len(city_positions)
+        if sorted_cities is None:
+            sorted_cities = self._sort_cities_by_distance(city_positions)
         # Set up connection points for all cities
         inner_connection_points, outer_connection_points, city_orientations, city_cells = \
             self._generate_city_connection_points(
                 city_positions, city_radius, vector_field, rails_between_cities,
-                rail_pairs_in_city, np_random=np_random)
+                rail_pairs_in_city, np_random=np_random, sorted_cities=sorted_cities)
 
         # Connect the cities through the connection points
         inter_city_lines = self._connect_cities(city_positions, outer_connection_points, city_cells,
-                                           rail_trans, grid_map)
+                                           rail_trans, grid_map, sorted_cities=sorted_cities)
 
         # Build inner cities
         free_rails = self._build_inner_cities(city_positions, inner_connection_points,
@@ -301,45 +410,50 @@ class SparseRailGen(RailGen):
             'city_orientations': city_orientations
         }}
 
-    def build_clique3(self, index_array, index):
-        closest_index1 = index_array[index][0]
-        closest_index2 = index_array[index][1]
-        closest_index3 = index_array[index][2]
-        clique3 = sorted([closest_index1, closest_index2, closest_index3])
-        return clique3
+    @staticmethod
+    def _sort_cities_by_distance(city_positions: IntVector2DArray) -> List[List[int]]:
+        """
+        For each city, the indices of all cities sorted by their manhattan distance to it, starting with the city
+        itself. Cities at the same distance keep their order.
+        """
+        positions = np.asarray(city_positions, dtype=int).reshape(-1, 2)
+        # manhattan distances between all pairs of cities
+        distance_array = np.abs(positions[:, np.newaxis, :] - positions[np.newaxis, :, :]).sum(axis=2)
+        return np.argsort(distance_array, axis=1, kind='stable').tolist()
 
-    def contains_cliques(self, city_positions):
+    def contains_cliques(self, city_positions, sorted_cities: List[List[int]] = None):
         """
         If we want to include the possibility of having dead end cities with only one entry/exit side, we need to
         exclude the possibility that cities are clustered into cliques of size 3 or 4 (at least for max_num_cities = 8).
-        To check for cliques of size 3 we check the closest two neighbours for every city, since they are all connected
-        in a 3-clique. For cliques of size 4 we also only check the two closest neighbours, because there is no direct
-        connection to the fourth city, but include four cities in our search.
-        """
-        distance_array = np.empty((len(city_positions), len(city_positions)), dtype=int)
-        sort_index = np.empty((len(city_positions), len(city_positions)), dtype=int)
-        for i in range(len(city_positions)):
-            for j in range(len(city_positions)):
-                distance_array[i][j] = Vec2d.get_manhattan_distance(city_positions[i], city_positions[j])
-        for i in range(len(city_positions)):
-            sort_index[i] = np.argsort(distance_array[i])
-        for i in range(len(city_positions)):
-            clique3 = self.build_clique3(sort_index, i)
-            clique31 = self.build_clique3(sort_index, clique3[1])
-            clique32 = self.build_clique3(sort_index, clique3[2])
-            if clique3 == clique31 and clique3 == clique32:
+        Every city is linked to its two closest neighbours, as these are the cities it gets connected to. A clique is
+        a group of 3 or 4 cities, but not all of them, that has no link leading out of it. Such a group is found as
+        the set of cities reachable from one of its members.
+        """
+        num_cities = len(city_positions)
+        # with at most 3 cities the two closest neighbours of any city are all other cities
+        if num_cities < 4:
+            return False
+        if sorted_cities is None:
+            sorted_cities = self._sort_cities_by_distance(city_positions)
+        # the closest city is the city itself
+        closest_neighbours = [sorted_neighbours[1:3] for sorted_neighbours in sorted_cities]
+        for i in range(num_cities):
+            # reachable cities as a bitmask over the city indices
+            reachable = 1 << i
+            num_reachable = 1
+            to_visit = [i]
+            while to_visit and num_reachable <= 4:
+                for neighbour in closest_neighbours[to_visit.pop()]:
+                    if not reachable >> neighbour & 1:
+                        reachable |= 1 << neighbour
+                        num_reachable += 1
+                        to_visit.append(neighbour)
+            if num_reachable <= 4 and num_reachable < num_cities:
                 return True
-            else:
-                cluster = list(dict.fromkeys(clique3 + clique31 + clique32))
-                if len(cluster) == 4:
-                    additional_element = list(set(cluster) - set(clique3))[0]
-                    clique33 = self.build_clique3(sort_index, additional_element)
-                    if cluster == list(dict.fromkeys(cluster + clique33)):
-                        return True
         return False
 
     def _generate_random_city_positions(self, num_cities: int, city_radius: int, width: int,
-                                        height: int, np_random: RandomState = None) -> Tuple[
+                                        height: int, np_random: Union[RandomState, Generator] = None) -> Tuple[
         IntVector2DArray, IntVector2DArray]:
         """
         Distribute the cities randomly in the environment while respecting city sizes and guaranteeing that they
@@ -364,22 +478,23 @@ class SparseRailGen(RailGen):
 
         city_positions: IntVector2DArray = []
 
-        # We track a grid of allowed indexes that can be sampled from for creating a new city
+        # We track the allowed indexes that can be sampled from for creating a new city
         # This removes the old sampling method of retrying a random sample on failure
-        allowed_grid = np.zeros((height, width), dtype=np.uint8)
         city_radius_pad1 = city_radius + 1
         # Borders have to be not allowed from the start
-        # allowed_grid == 1 indicates locations that are allowed
-        allowed_grid[city_radius_pad1:-city_radius_pad1, city_radius_pad1:-city_radius_pad1] = 1
+        # The allowed indexes are kept in row-major order, blocked indexes are removed from them
+        rows = np.arange(city_radius_pad1, height - city_radius_pad1)
+        cols = np.arange(city_radius_pad1, width - city_radius_pad1)
+        allowed_rows = np.repeat(rows, len(cols))
+        allowed_cols = np.tile(cols, len(rows))
         for _ in range(num_cities):
-            allowed_indexes = np.where(allowed_grid == 1)
-            num_allowed_points = len(allowed_indexes[0])
+            num_allowed_points = len(allowed_rows)
             if num_allowed_points == 0:
                 break
             # Sample one of the allowed indexes
-            point_index = np_random.randint(num_allowed_points)
-            row = int(allowed_indexes[0][point_index])
-            col = int(allowed_indexes[1][point_index])
+            point_index = _random_integers(np_random, num_allowed_points)
+            row = int(allowed_rows[point_index])
+            col = int(allowed_cols[point_index])
 
             # Need to block city radius and extra margin so that next sampling is correct
             # Clipping handles the case for negative indexes being generated
@@ -388,7 +503,15 @@ class SparseRailGen(RailGen):
             row_end = row + 2 * city_radius_pad1 + 1
             col_end = col + 2 * city_radius_pad1 + 1
 
-            allowed_grid[row_start : row_end, col_start : col_end] = 0
+            # Only the allowed indexes in the blocked rows have to be checked, they are contiguous as the rows are
+            # sorted
+            band_start, band_end = np.searchsorted(allowed_rows, (row_start, row_end))
+            band_cols = allowed_cols[band_start:band_end]
+            still_allowed = (band_cols < col_start) | (band_cols >= col_end)
+            allowed_rows = np.concatenate((allowed_rows[:band_start], allowed_rows[band_start:band_end][still_allowed],
+                                           allowed_rows[band_end:]))
+            allowed_cols = np.concatenate((allowed_cols[:band_start], band_cols[still_allowed],
+                                           allowed_cols[band_end:]))
 
             city_positions.append((row, col))
 
@@ -446,7 +569,8 @@ class SparseRailGen(RailGen):
 
     def _generate_city_connection_points(self, city_positions: IntVector2DArray, city_radius: int,
                                          vector_field: IntVector2DArray, rails_between_cities: int,
-                                         rail_pairs_in_city: int = 1, np_random: RandomState = None) -> Tuple[
+                                         rail_pairs_in_city: int = 1, np_random: Union[RandomState, Generator] = None,
+                                         sorted_cities: List[List[int]] = None) -> Tuple[
         List[List[List[IntVector2D]]],
         List[List[List[IntVector2D]]],
         List[np.ndarray],
@@ -469,6 +593,8 @@ class SparseRailGen(RailGen):
             Number of rails that connect out from the city
         rail_pairs_in_city: int
             Number of rails within the city
+        sorted_cities: List[List[int]]
+            For each city the indices of all cities sorted by distance, see _sort_cities_by_distance
 
         Returns
         -------
@@ -488,75 +614,46 @@ class SparseRailGen(RailGen):
         outer_connection_points: List[List[List[IntVector2D]]] = []
         city_orientations: List[Grid4TransitionsEnum] = []
         city_cells: IntVector2DArray = []
+        if sorted_cities is None:
+            sorted_cities = self._sort_cities_by_distance(city_positions)
+        if not self.grid_mode:
+            neighbour_directions = _closest_neighbour_directions(city_positions, sorted_cities)
 
-        for city_position in city_positions:
-
-            # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+        for city_idx, city_position in enumerate(city_positions):
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
-            idx = 1
             if self.grid_mode:
-                current_closest_direction = np_random.randint(4)
+                current_closest_direction = _random_integers(np_random, 4)
             else:
-                current_closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[idx]])
+                current_closest_direction = neighbour_directions[city_idx][0]
             connection_sides_idx.append(current_closest_direction)
             connection_sides_idx.append((current_closest_direction + 2) % 4)
             city_orientations.append(current_closest_direction)
             city_cells.extend(self._get_cells_in_city(city_position, city_radius, city_orientations[-1], vector_field))
-            # set the number of tracks within a city, at least 2 tracks per city
-            connections_per_direction = np.zeros(4, dtype=int)
+            # set the number of tracks within a city, at least 2 tracks per city, on the two connection sides
             # NEW : SCHED CONST
             # nr_of_connection_points = np_random.randint(1, rail_pairs_in_city + 1) * 2  # can be (1,2,3)*2 = (2,4,6)
             # we fix the number of connection points since we always want two tracks in between cities
-            nr_of_connection_points = np_random.randint(1, rail_pairs_in_city + 1) * 2
-            for idx in connection_sides_idx:
-                connections_per_direction[idx] = nr_of_connection_points
+            nr_of_connection_points = _random_integers(np_random, 1, rail_pairs_in_city + 1) * 2
             connection_points_coordinates_inner: List[List[IntVector2D]] = [[] for i in range(4)]
             connection_points_coordinates_outer: List[List[IntVector2D]] = [[] for i in range(4)]
             # number_of_out_rails = np_random.randint(1, min(rails_between_cities, nr_of_connection_points) + 1)
             # similarly we also fix the number of outgoing tracks to 2
             number_of_out_rails = 2
-            start_idx = int((nr_of_connection_points - number_of_out_rails) / 2)
-            for direction in range(4):
-                connection_slots = np.arange(nr_of_connection_points) - start_idx
-                # Offset the rails away from the center of the city
-                offset_distances = np.arange(nr_of_connection_points) - int(nr_of_connection_points / 2)
-                # The clipping helps offsetting one side more than the other to avoid switches at same locations
-                # The magic number plus one is added such that all points have at least one offset
-                inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
-                for connection_idx in range(connections_per_direction[direction]):
-                    if direction == 0:
-                        tmp_coordinates = (
-                            city_position[0] - city_radius + inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] - city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 1:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] + city_radius - inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] + city_radius)
-                    if direction == 2:
-                        tmp_coordinates = (
-                            city_position[0] + city_radius - inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 3:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] - city_radius + inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] - city_radius)
-                    connection_points_coordinates_inner[direction].append(tmp_coordinates)
-                    if connection_idx in range(start_idx, start_idx + number_of_out_rails):
-                        connection_points_coordinates_outer[direction].append(out_tmp_coordinates)
+            start_idx = (nr_of_connection_points - number_of_out_rails) // 2
+            connection_slots = np.arange(nr_of_connection_points) - start_idx
+            # Offset the rails away from the center of the city
+            offset_distances = np.arange(nr_of_connection_points) - nr_of_connection_points // 2
+            # The clipping helps offsetting one side more than the other to avoid switches at same locations
+            # The magic number plus one is added such that all points have at least one offset
+            inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
+            inner_points, outer_points = \
+                _connection_points_on_borders(city_position, city_radius, connection_sides_idx[0], connection_slots,
+                                              inner_point_offset, start_idx, number_of_out_rails)
+            for direction, inner, outer in zip(connection_sides_idx, inner_points, outer_points):
+                connection_points_coordinates_inner[direction] = inner
+                connection_points_coordinates_outer[direction] = outer
 
             inner_connection_points.append(connection_points_coordinates_inner)
             outer_connection_points.append(connection_points_coordinates_outer)
@@ -564,7 +661,8 @@ class SparseRailGen(RailGen):
 
     def _connect_cities(self, city_positions: IntVector2DArray, connection_points: List[List[List[IntVector2D]]],
                         city_cells: IntVector2DArray,
-                        rail_trans: RailEnvTransitions, grid_map: RailEnvTransitions) -> List[IntVector2DArray]:
+                        rail_trans: RailEnvTransitions, grid_map: RailEnvTransitions,
+                        sorted_cities: List[List[int]] = None) -> List[IntVector2DArray]:
         """
         Connects cities together through rails. Each city connects from its outgoing connection points to the closest
         cities. This guarantees that all connection points are used.
@@ -582,6 +680,8 @@ class SparseRailGen(RailGen):
             Railway transition objects
         grid_map: RailEnvTransitions
             The grid map containing the rails. Used to draw new rails
+        sorted_cities: List[List[int]]
+            For each city the indices of all cities sorted by distance, see _sort_cities_by_distance
 
         Returns
         -------
@@ -589,72 +689,54 @@ class SparseRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
         set_of_connections = []
+        if sorted_cities is None:
+            sorted_cities = self._sort_cities_by_distance(city_positions)
+        neighbour_directions = _closest_neighbour_directions(city_positions, sorted_cities)
         for current_city_idx in np.arange(len(city_positions)):
-            closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
             city_position = city_positions[current_city_idx]
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
-            closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[1]])
+            closest_neighb_idx = sorted_cities[current_city_idx]
+            closest_direction = neighbour_directions[current_city_idx][0]
             if not connection_points[current_city_idx][closest_direction]:
                 closest_direction = (closest_direction + 1) % 4
                 second_closest_direction = (closest_direction + 2) % 4
             else:
-                second_closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[2]])
+                second_closest_direction = neighbour_directions[current_city_idx][1]
                 if not connection_points[current_city_idx][second_closest_direction]:
                     second_closest_direction = (closest_direction + 2) % 4
             out_direction = closest_direction
-            connection_points_copy = copy.deepcopy(connection_points)
+            # the connection points of the neighbour that are still free, only these lists get modified
+            neighbour_points = [list(points) for points in connection_points[closest_neighb_idx[1]]]
             i = 0
             for city_out_connection_point in connection_points[current_city_idx][out_direction]:
                 if i % 2 == 0:
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points_copy[closest_neighb_idx[1]][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
-                                city_out_connection_point = city_out_connection_point
-                                current_direction = direction
-                                neighbour_index_for_connection = closest_neighb_idx[1]
+                    current_direction, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, neighbour_points)
+                    neighbour_index_for_connection = closest_neighb_idx[1]
                     # choose always the first connection point of a neighbour, because the list is ordered, same as the
                     # list of the outer connection point
                     possible_connection = [current_city_idx, neighbour_index_for_connection]
                     reversed_possible_connection = [neighbour_index_for_connection, current_city_idx]
-                    city_direction = direction_to_point(city_position, city_out_connection_point)
-                    neighbour_direction = direction_to_point(city_positions[closest_neighb_idx[1]], neighbour_connection_point)
+                    # outer connection points lie on the border of their side, so that is the direction to them
+                    city_direction = out_direction
+                    neighbour_direction = current_direction
                     if reversed_possible_connection not in set_of_connections:
                         if city_direction + neighbour_direction in [1, 5] or city_direction == neighbour_direction:
-                            neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][1]
-                            next_neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][0]
+                            point_idx, next_point_idx = 1, 0
                         else:
-                            neighbour_connection_point = connection_points_copy[closest_neighb_idx[1]][current_direction][0]
-                            next_neighbour_connection_point = \
-                                connection_points_copy[closest_neighb_idx[1]][current_direction][1]
-                        connection_points_copy[closest_neighb_idx[1]][current_direction].remove(neighbour_connection_point)
+                            point_idx, next_point_idx = 0, 1
+                        # remove the chosen point by its index, the order of the remaining points matters
+                        next_neighbour_connection_point = neighbour_points[current_direction][next_point_idx]
+                        neighbour_connection_point = neighbour_points[current_direction].pop(point_idx)
                         last_city_out_connection_point = city_out_connection_point
 
                     else:
                         i += 1
                 else:
-                    if (city_direction == 0 or city_direction == 1)  and \
-                        ((neighbour_connection_point[0] < last_city_out_connection_point[0] and \
-                        neighbour_connection_point[1] > last_city_out_connection_point[1]) or \
-                        (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
-                        neighbour_connection_point[1] < last_city_out_connection_point[1])) or \
-                        (city_direction == 2 or city_direction == 3) and \
-                        ((neighbour_connection_point[0] < last_city_out_connection_point[0] and \
-                          neighbour_connection_point[1] < last_city_out_connection_point[1]) or \
-                         (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
-                          neighbour_connection_point[1] > last_city_out_connection_point[1])):
+                    if _on_matching_diagonal(city_direction, last_city_out_connection_point,
+                                             neighbour_connection_point):
 
                         new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point,
                                                             next_neighbour_connection_point,
@@ -662,7 +744,7 @@ class SparseRailGen(RailGen):
                                                             flip_end_node_trans=False,
                                                             respect_transition_validity=False,
                                                             avoid_rail=True,
-                                                            forbidden_cells=city_cells)
+                                                            forbidden_cells=city_mask)
                         if len(new_line) == 0:
                             warnings.warn("[WARNING] No line added between stations")
                         elif new_line[-1] != next_neighbour_connection_point or new_line[
@@ -676,7 +758,7 @@ class SparseRailGen(RailGen):
                                                             flip_end_node_trans=False,
                                                             respect_transition_validity=False,
                                                             avoid_rail=True,
-                                                            forbidden_cells=city_cells)
+                                                            forbidden_cells=city_mask)
                         if len(new_line) == 0:
                             warnings.warn("[WARNING] No line added between stations")
                         elif new_line[-1] != neighbour_connection_point or new_line[
@@ -690,7 +772,7 @@ class SparseRailGen(RailGen):
                                                             rail_trans, flip_start_node_trans=False,
                                                             flip_end_node_trans=False, respect_transition_validity=False,
                                                             avoid_rail=True,
-                                                            forbidden_cells=city_cells)
+                                                            forbidden_cells=city_mask)
                         if len(new_line) == 0:
                             warnings.warn("[WARNING] No line added between stations")
                         elif new_line[-1] != neighbour_connection_point or new_line[0] != last_city_out_connection_point:
@@ -702,7 +784,7 @@ class SparseRailGen(RailGen):
                                                             rail_trans, flip_start_node_trans=False,
                                                             flip_end_node_trans=False, respect_transition_validity=False,
                                                             avoid_rail=True,
-                                                            forbidden_cells=city_cells)
+                                                            forbidden_cells=city_mask)
                         if len(new_line) == 0:
                             warnings.warn("[WARNING] No line added between stations")
                         elif new_line[-1] != next_neighbour_connection_point or new_line[0] != city_out_connection_point:
@@ -711,52 +793,33 @@ class SparseRailGen(RailGen):
                 i += 1
             if closest_direction != second_closest_direction:
                 out_direction = second_closest_direction
-                connection_points_copy = copy.deepcopy(connection_points)
+                neighbour_points = [list(points) for points in connection_points[closest_neighb_idx[2]]]
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
                     if i % 2 == 0:
-                        min_connection_dist = np.inf
-                        for direction in grid4_directions:
-                            current_points = connection_points_copy[closest_neighb_idx[2]][direction]
-                            for tmp_in_connection_point in current_points:
-                                tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                                      tmp_in_connection_point)
-                                if tmp_dist < min_connection_dist:
-                                    min_connection_dist = tmp_dist
-                                    neighbour_connection_point = tmp_in_connection_point
-                                    city_out_connection_point = city_out_connection_point
-                                    current_direction = direction
-                                    neighbour_index_for_connection = closest_neighb_idx[2]
+                        current_direction, neighbour_connection_point = \
+                            _closest_connection_point(city_out_connection_point, neighbour_points)
+                        neighbour_index_for_connection = closest_neighb_idx[2]
 
                         possible_connection = [current_city_idx, neighbour_index_for_connection]
                         reversed_possible_connection = [neighbour_index_for_connection, current_city_idx]
-                        city_direction = direction_to_point(city_position, city_out_connection_point)
-                        neighbour_direction = direction_to_point(city_positions[closest_neighb_idx[2]], neighbour_connection_point)
+                        # outer connection points lie on the border of their side, so that is the direction to them
+                        city_direction = out_direction
+                        neighbour_direction = current_direction
                         if reversed_possible_connection not in set_of_connections:
                             if city_direction + neighbour_direction in [1, 5] or city_direction == neighbour_direction:
-                                neighbour_connection_point = \
-                                    connection_points_copy[closest_neighb_idx[2]][current_direction][1]
-                                next_neighbour_connection_point = \
-                                    connection_points_copy[closest_neighb_idx[2]][current_direction][0]
+                                point_idx, next_point_idx = 1, 0
                             else:
-                                neighbour_connection_point = connection_points_copy[closest_neighb_idx[2]][current_direction][0]
-                                next_neighbour_connection_point = \
-                                connection_points_copy[closest_neighb_idx[2]][current_direction][1]
-                            connection_points_copy[closest_neighb_idx[2]][current_direction].remove(neighbour_connection_point)
+                                point_idx, next_point_idx = 0, 1
+                            # remove the chosen point by its index, the order of the remaining points matters
+                            next_neighbour_connection_point = neighbour_points[current_direction][next_point_idx]
+                            neighbour_connection_point = neighbour_points[current_direction].pop(point_idx)
                             last_city_out_connection_point = city_out_connection_point
 
                         else:
                             i += 1
                     else:
-                        if (city_direction == 0 or city_direction == 1)  and \
-                        ((neighbour_connection_point[0] < last_city_out_connection_point[0] and \
-                        neighbour_connection_point[1] > last_city_out_connection_point[1]) or \
-                        (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
-                        neighbour_connection_point[1] < last_city_out_connection_point[1])) or \
-                        (city_direction == 2 or city_direction == 3) and \
-                        ((neighbour_connection_point[0] < last_city_out_connection_point[0] and \
-                          neighbour_connection_point[1] < last_city_out_connection_point[1]) or \
-                         (neighbour_connection_point[0] > last_city_out_connection_point[0] and \
-                          neighbour_connection_point[1] > last_city_out_connection_point[1])):
+                        if _on_matching_diagonal(city_direction, last_city_out_connection_point,
+                                                 neighbour_connection_point):
 
                             new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point,
                                                                 next_neighbour_connection_point,
@@ -764,7 +827,7 @@ class SparseRailGen(RailGen):
                                                                 flip_end_node_trans=False,
                                                                 respect_transition_validity=False,
                                                                 avoid_rail=True,
-                                                                forbidden_cells=city_cells)
+                                                                forbidden_cells=city_mask)
                             if len(new_line) == 0:
                                 warnings.warn("[WARNING] No line added between stations")
                             elif new_line[-1] != next_neighbour_connection_point or new_line[
@@ -778,7 +841,7 @@ class SparseRailGen(RailGen):
                                                                 flip_end_node_trans=False,
                                                                 respect_transition_validity=False,
                                                                 avoid_rail=True,
-                                                                forbidden_cells=city_cells)
+                                                                forbidden_cells=city_mask)
                             if len(new_line) == 0:
                                 warnings.warn("[WARNING] No line added between stations")
                             elif new_line[-1] != neighbour_connection_point or new_line[
@@ -794,7 +857,7 @@ class SparseRailGen(RailGen):
                                                                 flip_end_node_trans=False,
                                                                 respect_transition_validity=False,
                                                                 avoid_rail=True,
-                                                                forbidden_cells=city_cells)
+                                                                forbidden_cells=city_mask)
                             if len(new_line) == 0:
                                 warnings.warn("[WARNING] No line added between stations")
                             elif new_line[-1] != neighbour_connection_point or new_line[0] != last_city_out_connection_point:
@@ -808,7 +871,7 @@ class SparseRailGen(RailGen):
                                                                 flip_end_node_trans=False,
                                                                 respect_transition_validity=False,
                                                                 avoid_rail=True,
-                                                                forbidden_cells=city_cells)
+                                                                forbidden_cells=city_mask)
                             if len(new_line) == 0:
                                 warnings.warn("[WARNING] No line added between stations")
                             elif new_line[-1] != next_neighbour_connection_point or new_line[0] != city_out_connection_point:
@@ -898,7 +961,7 @@ class SparseRailGen(RailGen):
             opposite_boarder = (boarder + 2) % 4
             nr_of_connection_points = len(inner_connection_points[current_city][boarder])
             number_of_out_rails = len(outer_connection_points[current_city][boarder])
-            start_idx = int((nr_of_connection_points - number_of_out_rails) / 2)
+            start_idx = (nr_of_connection_points - number_of_out_rails) // 2
             # Connect parallel tracks
             for track_id in range(nr_of_connection_points):
                 source = inner_connection_points[current_city][boarder][track_id]
@@ -949,7 +1012,7 @@ class SparseRailGen(RailGen):
         for current_city in range(len(city_positions)):
             for track_nbr in range(len(free_rails[current_city])):
                 possible_location = free_rails[current_city][track_nbr][
-                    int(len(free_rails[current_city][track_nbr]) / 2)]
+                    len(free_rails[current_city][track_nbr]) // 2]
                 train_stations[current_city].append((possible_location, track_nbr))
         return train_stations
 
@@ -1005,23 +1068,18 @@ class SparseRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
-
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
@@ -1074,9 +1132,12 @@ class SparseRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
 
     @staticmethod
@@ -1136,7 +1197,7 @@ class CustomRailGen(RailGen):
         self.seed = seed
 
     def generate(self, width: int, height: int, num_agents: int, num_resets: int = 0,
-                 np_random: RandomState = None) -> RailGenerator:
+                 np_random: Union[RandomState, Generator] = None) -> RailGenerator:
         """
 
         Parameters
@@ -1163,9 +1224,9 @@ class CustomRailGen(RailGen):
         if self.seed is not None:
             np_random = RandomState(self.seed)
         elif np_random is None:
-            np_random = RandomState(np.random.randint(2**32))
+            np_random = np.random.default_rng(np.random.randint(2**32))
 
-        rail_trans = RailEnvTransitions()
+        rail_trans = _RAIL_TRANSITIONS
         rail, rail_map, optionals = make_custom_rail()
         grid_map = rail
 
@@ -1225,7 +1286,8 @@ class CustomRailGen(RailGen):
 
     def _generate_city_connection_points(self, city_positions: IntVector2DArray, city_radius: int,
                                          vector_field: IntVector2DArray, rails_between_cities: int,
-                                         rail_pairs_in_city: int = 1, np_random: RandomState = None) -> Tuple[
+                                         rail_pairs_in_city: int = 1,
+                                         np_random: Union[RandomState, Generator] = None) -> Tuple[
         List[List[List[IntVector2D]]],
         List[List[List[IntVector2D]]],
         List[np.ndarray],
@@ -1271,67 +1333,41 @@ class CustomRailGen(RailGen):
         for city_position in city_positions:
 
             # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
             idx = 1
             if self.grid_mode:
-                current_closest_direction = np_random.randint(4)
+                current_closest_direction = _random_integers(np_random, 4)
             else:
                 current_closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[idx]])
             connection_sides_idx.append(current_closest_direction)
             connection_sides_idx.append((current_closest_direction + 2) % 4)
             city_orientations.append(current_closest_direction)
             city_cells.extend(self._get_cells_in_city(city_position, city_radius, city_orientations[-1], vector_field))
-            # set the number of tracks within a city, at least 2 tracks per city
-            connections_per_direction = np.zeros(4, dtype=int)
+            # set the number of tracks within a city, at least 2 tracks per city, on the two connection sides
             # NEW : SCHED CONST
-            nr_of_connection_points = np_random.randint(1, rail_pairs_in_city + 1) * 2  # can be (1,2,3)*2 = (2,4,6)
-            for idx in connection_sides_idx:
-                connections_per_direction[idx] = nr_of_connection_points
+            # can be (1,2,3)*2 = (2,4,6)
+            nr_of_connection_points = _random_integers(np_random, 1, rail_pairs_in_city + 1) * 2
             connection_points_coordinates_inner: List[List[IntVector2D]] = [[] for i in range(4)]
             connection_points_coordinates_outer: List[List[IntVector2D]] = [[] for i in range(4)]
-            number_of_out_rails = np_random.randint(1, min(rails_between_cities, nr_of_connection_points) + 1)
+            number_of_out_rails = _random_integers(np_random, 1, min(rails_between_cities, nr_of_connection_points) + 1)
             start_idx = int((nr_of_connection_points - number_of_out_rails) / 2)
-            for direction in range(4):
-                connection_slots = np.arange(nr_of_connection_points) - start_idx
-                # Offset the rails away from the center of the city
-                offset_distances = np.arange(nr_of_connection_points) - int(nr_of_connection_points / 2)
-                # The clipping helps ofsetting one side more than the other to avoid switches at same locations
-                # The magic number plus one is added such that all points have at least one offset
-                inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
-                for connection_idx in range(connections_per_direction[direction]):
-                    if direction == 0:
-                        tmp_coordinates = (
-                            city_position[0] - city_radius + inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] - city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 1:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] + city_radius - inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] + city_radius)
-                    if direction == 2:
-                        tmp_coordinates = (
-                            city_position[0] + city_radius - inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 3:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] - city_radius + inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] - city_radius)
-                    connection_points_coordinates_inner[direction].append(tmp_coordinates)
-                    if connection_idx in range(start_idx, start_idx + number_of_out_rails):
-                        connection_points_coordinates_outer[direction].append(out_tmp_coordinates)
+            connection_slots = np.arange(nr_of_connection_points) - start_idx
+            # Offset the rails away from the center of the city
+            offset_distances = np.arange(nr_of_connection_points) - int(nr_of_connection_points / 2)
+            # The clipping helps ofsetting one side more than the other to avoid switches at same locations
+            # The magic number plus one is added such that all points have at least one offset
+            inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
+            inner_points, outer_points = \
+                _connection_points_on_borders(city_position, city_radius, connection_sides_idx[0], connection_slots,
+                                              inner_point_offset, start_idx, number_of_out_rails)
+            for direction, inner, outer in zip(connection_sides_idx, inner_points, outer_points):
+                connection_points_coordinates_inner[direction] = inner
+                connection_points_coordinates_outer[direction] = outer
 
             inner_connection_points.append(connection_points_coordinates_inner)
             outer_connection_points.append(connection_points_coordinates_outer)
@@ -1364,31 +1400,23 @@ class CustomRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
         for current_city_idx in np.arange(len(city_positions)):
             closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
-            for out_direction in grid4_directions:
+            for out_direction in _GRID4_DIRECTIONS:
 
                 neighbour_idx = self.get_closest_neighbour_for_direction(closest_neighbours, out_direction)
 
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
 
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points[neighbour_idx][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
+                    _, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, connection_points[neighbour_idx])
                     new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point, neighbour_connection_point,
                                                         rail_trans, flip_start_node_trans=False,
                                                         flip_end_node_trans=False, respect_transition_validity=False,
                                                         avoid_rail=True,
-                                                        forbidden_cells=city_cells)
+                                                        forbidden_cells=city_mask)
                     if len(new_line) == 0:
                         warnings.warn("[WARNING] No line added between stations")
                     elif new_line[-1] != neighbour_connection_point or new_line[0] != city_out_connection_point:
@@ -1487,23 +1515,18 @@ class CustomRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
-
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
@@ -1556,9 +1579,12 @@ class CustomRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
 
 
@@ -1598,7 +1624,7 @@ class TestRailGen(RailGen):
         self.seed = seed
 
     def generate(self, width: int, height: int, num_agents: int, num_resets: int = 0,
-                 np_random: RandomState = None) -> RailGenerator:
+                 np_random: Union[RandomState, Generator] = None) -> RailGenerator:
         """
 
         Parameters
@@ -1625,9 +1651,9 @@ class TestRailGen(RailGen):
         if self.seed is not None:
             np_random = RandomState(self.seed)
         elif np_random is None:
-            np_random = RandomState(np.random.randint(2**32))
+            np_random = np.random.default_rng(np.random.randint(2**32))
 
-        rail_trans = RailEnvTransitions()
+        rail_trans = _RAIL_TRANSITIONS
         rail, rail_map, optionals = make_double_track()
         grid_map = rail
 
@@ -1685,7 +1711,8 @@ class TestRailGen(RailGen):
 
     def _generate_city_connection_points(self, city_positions: IntVector2DArray, city_radius: int,
                                          vector_field: IntVector2DArray, rails_between_cities: int,
-                                         rail_pairs_in_city: int = 1, np_random: RandomState = None) -> Tuple[
+                                         rail_pairs_in_city: int = 1,
+                                         np_random: Union[RandomState, Generator] = None) -> Tuple[
         List[List[List[IntVector2D]]],
         List[List[List[IntVector2D]]],
         List[np.ndarray],
@@ -1731,67 +1758,41 @@ class TestRailGen(RailGen):
         for city_position in city_positions:
 
             # Chose the directions where close cities are situated
-            neighb_dist = []
-            for neighbour_city in city_positions:
-                neighb_dist.append(Vec2dOperations.get_manhattan_distance(city_position, neighbour_city))
-            closest_neighb_idx = self.__class__.argsort(neighb_dist)
+            neighb_dist = np.abs(np.asarray(city_positions) - city_position).sum(axis=1)
+            # stable, so that equally distant cities keep their order
+            closest_neighb_idx = np.argsort(neighb_dist, kind='stable')
 
             # Store the directions to these neighbours and orient city to face closest neighbour
             connection_sides_idx = []
             idx = 1
             if self.grid_mode:
-                current_closest_direction = np_random.randint(4)
+                current_closest_direction = _random_integers(np_random, 4)
             else:
                 current_closest_direction = direction_to_point(city_position, city_positions[closest_neighb_idx[idx]])
             connection_sides_idx.append(current_closest_direction)
             connection_sides_idx.append((current_closest_direction + 2) % 4)
             city_orientations.append(current_closest_direction)
             city_cells.extend(self._get_cells_in_city(city_position, city_radius, city_orientations[-1], vector_field))
-            # set the number of tracks within a city, at least 2 tracks per city
-            connections_per_direction = np.zeros(4, dtype=int)
+            # set the number of tracks within a city, at least 2 tracks per city, on the two connection sides
             # NEW : SCHED CONST
-            nr_of_connection_points = np_random.randint(1, rail_pairs_in_city + 1) * 2  # can be (1,2,3)*2 = (2,4,6)
-            for idx in connection_sides_idx:
-                connections_per_direction[idx] = nr_of_connection_points
+            # can be (1,2,3)*2 = (2,4,6)
+            nr_of_connection_points = _random_integers(np_random, 1, rail_pairs_in_city + 1) * 2
             connection_points_coordinates_inner: List[List[IntVector2D]] = [[] for i in range(4)]
             connection_points_coordinates_outer: List[List[IntVector2D]] = [[] for i in range(4)]
-            number_of_out_rails = np_random.randint(1, min(rails_between_cities, nr_of_connection_points) + 1)
+            number_of_out_rails = _random_integers(np_random, 1, min(rails_between_cities, nr_of_connection_points) + 1)
             start_idx = int((nr_of_connection_points - number_of_out_rails) / 2)
-            for direction in range(4):
-                connection_slots = np.arange(nr_of_connection_points) - start_idx
-                # Offset the rails away from the center of the city
-                offset_distances = np.arange(nr_of_connection_points) - int(nr_of_connection_points / 2)
-                # The clipping helps ofsetting one side more than the other to avoid switches at same locations
-                # The magic number plus one is added such that all points have at least one offset
-                inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
-                for connection_idx in range(connections_per_direction[direction]):
-                    if direction == 0:
-                        tmp_coordinates = (
-                            city_position[0] - city_radius + inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] - city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 1:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] + city_radius - inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] + city_radius)
-                    if direction == 2:
-                        tmp_coordinates = (
-                            city_position[0] + city_radius - inner_point_offset[connection_idx],
-                            city_position[1] + connection_slots[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + city_radius, city_position[1] + connection_slots[connection_idx])
-                    if direction == 3:
-                        tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx],
-                            city_position[1] - city_radius + inner_point_offset[connection_idx])
-                        out_tmp_coordinates = (
-                            city_position[0] + connection_slots[connection_idx], city_position[1] - city_radius)
-                    connection_points_coordinates_inner[direction].append(tmp_coordinates)
-                    if connection_idx in range(start_idx, start_idx + number_of_out_rails):
-                        connection_points_coordinates_outer[direction].append(out_tmp_coordinates)
+            connection_slots = np.arange(nr_of_connection_points) - start_idx
+            # Offset the rails away from the center of the city
+            offset_distances = np.arange(nr_of_connection_points) - int(nr_of_connection_points / 2)
+            # The clipping helps ofsetting one side more than the other to avoid switches at same locations
+            # The magic number plus one is added such that all points have at least one offset
+            inner_point_offset = np.abs(offset_distances) + np.clip(offset_distances, 0, 1) + 1
+            inner_points, outer_points = \
+                _connection_points_on_borders(city_position, city_radius, connection_sides_idx[0], connection_slots,
+                                              inner_point_offset, start_idx, number_of_out_rails)
+            for direction, inner, outer in zip(connection_sides_idx, inner_points, outer_points):
+                connection_points_coordinates_inner[direction] = inner
+                connection_points_coordinates_outer[direction] = outer
 
             inner_connection_points.append(connection_points_coordinates_inner)
             outer_connection_points.append(connection_points_coordinates_outer)
@@ -1824,31 +1825,23 @@ class TestRailGen(RailGen):
         cells later.
         """
         all_paths: List[IntVector2DArray] = []
+        city_mask = _CellMask(grid_map.height, grid_map.width, city_cells)
 
-        grid4_directions = [Grid4TransitionsEnum.NORTH, Grid4TransitionsEnum.EAST, Grid4TransitionsEnum.SOUTH,
-                            Grid4TransitionsEnum.WEST]
         for current_city_idx in np.arange(len(city_positions)):
             closest_neighbours = self._closest_neighbour_in_grid4_directions(current_city_idx, city_positions)
-            for out_direction in grid4_directions:
+            for out_direction in _GRID4_DIRECTIONS:
 
                 neighbour_idx = self.get_closest_neighbour_for_direction(closest_neighbours, out_direction)
 
                 for city_out_connection_point in connection_points[current_city_idx][out_direction]:
 
-                    min_connection_dist = np.inf
-                    for direction in grid4_directions:
-                        current_points = connection_points[neighbour_idx][direction]
-                        for tmp_in_connection_point in current_points:
-                            tmp_dist = Vec2dOperations.get_manhattan_distance(city_out_connection_point,
-                                                                              tmp_in_connection_point)
-                            if tmp_dist < min_connection_dist:
-                                min_connection_dist = tmp_dist
-                                neighbour_connection_point = tmp_in_connection_point
+                    _, neighbour_connection_point = \
+                        _closest_connection_point(city_out_connection_point, connection_points[neighbour_idx])
                     new_line = connect_rail_in_grid_map(grid_map, city_out_connection_point, neighbour_connection_point,
                                                         rail_trans, flip_start_node_trans=False,
                                                         flip_end_node_trans=False, respect_transition_validity=False,
                                                         avoid_rail=True,
-                                                        forbidden_cells=city_cells)
+                                                        forbidden_cells=city_mask)
                     if len(new_line) == 0:
                         warnings.warn("[WARNING] No line added between stations")
                     elif new_line[-1] != neighbour_connection_point or new_line[0] != city_out_connection_point:
@@ -1947,23 +1940,18 @@ class TestRailGen(RailGen):
         Returns indices of closest neighbour in every direction NESW
         """
 
-        city_distances = []
         closest_neighbour: List[int] = [None for i in range(4)]
 
-        # compute distance to all other cities
-        for city_idx in range(len(city_positions)):
-            city_distances.append(
-                Vec2dOperations.get_manhattan_distance(city_positions[current_city_idx], city_positions[city_idx]))
-        sorted_neighbours = np.argsort(city_distances)
-
-        for neighbour in sorted_neighbours[1:]:  # do not include city itself
-            direction_to_neighbour = direction_to_point(city_positions[current_city_idx], city_positions[neighbour])
-            if closest_neighbour[direction_to_neighbour] is None:
-                closest_neighbour[direction_to_neighbour] = neighbour
+        # the differences to all other cities give both their distances and their directions
+        position_diffs = np.asarray(city_positions[current_city_idx]) - np.asarray(city_positions)
+        city_distances = np.abs(position_diffs).sum(axis=1)
+        sorted_neighbours = np.argsort(city_distances)[1:]  # do not include city itself
+        neighbour_directions = _directions_from_differences(position_diffs)[sorted_neighbours]
 
-            # early return once all 4 directions have a closest neighbour
-            if None not in closest_neighbour:
-                return closest_neighbour
+        for direction in range(4):
+            neighbours_in_direction = np.flatnonzero(neighbour_directions == direction)
+            if len(neighbours_in_direction) > 0:
+                closest_neighbour[direction] = sorted_neighbours[neighbours_in_direction[0]]
 
         return closest_neighbour
 
@@ -2016,7 +2004,10 @@ class TestRailGen(RailGen):
         y_range = np.arange(center[1] - radius, center[1] + radius + 1)
         x_values = np.repeat(x_range, len(y_range))
         y_values = np.tile(y_range, len(x_range))
-        city_cells = list(zip(x_values, y_values))
-        for cell in city_cells:
-            vector_field[cell] = align_cell_to_city(center, city_orientation, cell)
+        city_cells = list(zip(x_values.tolist(), y_values.tolist()))
+        # Align all cells to face the city center along the city orientation, as align_cell_to_city does per cell
+        if city_orientation % 2 == 0:
+            vector_field[x_values, y_values] = 2 * np.clip(x_values - center[0], 0, 1)
+        else:
+            vector_field[x_values, y_values] = 2 * np.clip(center[1] - y_values, 0, 1) + 1
         return city_cells
@@ -0,0 +1,71 @@
+import numpy as np
+from numpy.random import RandomState
+
+from flatland.core.grid.rail_env_grid import RailEnvTransitions
+from flatland.core.transition_map import GridTransitionMap
+
+from flatland.envs.grid4_generators_utils import connect_straight_line_in_grid_map
+
+from custom_rail_gen.rail_generators import SparseRailGen, _connect_parallel_lines_in_grid_map, _invalid_cells_mask
+
+
+class _UnfixedGridRailGen(SparseRailGen):
+    """ Keeps the grids before and after _fix_transitions """
+    def _fix_transitions(self, city_cells, inter_city_lines, grid_map, vector_field):
+        self.unfixed_grid = grid_map.grid.copy()
+        super()._fix_transitions(city_cells, inter_city_lines, grid_map, vector_field)
+        self.fixed_grid = grid_map.grid.copy()
+
+
+def _assert_mask_matches_cell_neighbours_valid(grid_map):
+    invalid_cells = _invalid_cells_mask(grid_map)
+    for row in range(grid_map.height):
+        for col in range(grid_map.width):
+            assert invalid_cells[row, col] == (not grid_map.cell_neighbours_valid((row, col), True)), (row, col)
+
+
+def test_invalid_cells_mask_on_generated_maps():
+    rail_trans = RailEnvTransitions()
+    for seed in range(3):
+        rail_generator = _UnfixedGridRailGen(max_num_cities=6, seed=seed)
+        rail_generator.generate(40, 40, 5, 0, RandomState(seed))
+        grid_map = GridTransitionMap(width=40, height=40, transitions=rail_trans)
+        for grid in (rail_generator.unfixed_grid, rail_generator.fixed_grid):
+            grid_map.grid[:] = grid
+            _assert_mask_matches_cell_neighbours_valid(grid_map)
+
+
+def test_invalid_cells_mask_on_random_maps():
+    rail_trans = RailEnvTransitions()
+    transitions = list(rail_trans.transitions_all)
+    np_random = RandomState(0)
+    for height, width in ((1, 1), (1, 6), (5, 1), (7, 9)):
+        grid_map = GridTransitionMap(width=width, height=height, transitions=rail_trans)
+        # any transition bits, only valid transitions, and valid transitions with empty cells in between
+        grid_map.grid[:] = np_random.randint(0, 2 ** 16, size=(height, width))
+        _assert_mask_matches_cell_neighbours_valid(grid_map)
+        grid_map.grid[:] = np_random.choice(transitions, size=(height, width))
+        _assert_mask_matches_cell_neighbours_valid(grid_map)
+        grid_map.grid[:] = np_random.choice(transitions, size=(height, width)) * (np_random.rand(height, width) < 0.5)
+        _assert_mask_matches_cell_neighbours_valid(grid_map)
+
+
+def test_connect_parallel_lines_matches_straight_lines():
+    rail_trans = RailEnvTransitions()
+    transitions = list(rail_trans.transitions_all)
+    np_random = RandomState(0)
+    # tracks of different lengths, as in a city, running south, north, east and west
+    south = ([(2, 3), (1, 4), (3, 5)], [(8, 3), (9, 4), (7, 5)])
+    east = ([(3, 2), (4, 1), (5, 3)], [(3, 8), (4, 9), (5, 7)])
+    for starts, ends in (south, south[::-1], east, east[::-1]):
+        grid_map = GridTransitionMap(width=11, height=11, transitions=rail_trans)
+        # the lines are added to transitions already in the grid
+        grid_map.grid[:] = np_random.choice(transitions, size=(11, 11)) * (np_random.rand(11, 11) < 0.3)
+        expected_grid_map = GridTransitionMap(width=11, height=11, transitions=rail_trans)
+        expected_grid_map.grid[:] = grid_map.grid
+
+        paths = _connect_parallel_lines_in_grid_map(grid_map, starts, ends, rail_trans)
+        expected_paths = [connect_straight_line_in_grid_map(expected_grid_map, start, end, rail_trans)
+                          for start, end in zip(starts, ends)]
+        assert paths == expected_paths
+        assert np.array_equal(grid_map.grid, expected_grid_map.grid)
@@ -0,0 +1,82 @@
+import numpy as np
+
+from flatland1.envs.line_generators import _STATION_HALVES, _choose_station_indices
+
+CITY_RADIUS = 4
+
+
+def _original_station_halves(city1_orientation, city2_orientation, dx, dy, city_radius):
+    """ The decision tree of the sparse line generator before it was replaced by _STATION_HALVES.
+        Returns whether the start in city1, the next target in city1, the target in city2 and the next start in city2
+        lie in the upper half of the stations of their city.
+    """
+    if city1_orientation == 0 or city1_orientation == 2:
+        if dx > 0:
+            start_upper1 = False
+            if city2_orientation == 0 or city2_orientation == 2:
+                if dx > city_radius + 1:
+                    target_upper2 = False
+                else:
+                    target_upper2 = True
+        else:
+            start_upper1 = True
+            if city2_orientation == 0 or city2_orientation == 2:
+                if dx < - city_radius - 1:
+                    target_upper2 = True
+                else:
+                    target_upper2 = False
+        if city2_orientation == 1 or city2_orientation == 3:
+            if dy > 0:
+                target_upper2 = True
+            else:
+                target_upper2 = False
+    else:
+        if dy > 0:
+            start_upper1 = True
+            if city2_orientation == 1 or city2_orientation == 3:
+                if dy > city_radius + 1:
+                    target_upper2 = True
+                else:
+                    target_upper2 = False
+        else:
+            start_upper1 = False
+            if city2_orientation == 1 or city2_orientation == 3:
+                if dy < - city_radius - 1:
+                    target_upper2 = False
+                else:
+                    target_upper2 = True
+        if city2_orientation == 0 or city2_orientation == 2:
+            if dx > 0:
+                target_upper2 = False
+            else:
+                target_upper2 = True
+    return start_upper1, not start_upper1, target_upper2, not target_upper2
+
+
+def _offset(positive, far_apart):
+    """ A relative position along an axis that is positive or not, and further apart than the city radius + 1 or not
+    """
+    if far_apart:
+        return CITY_RADIUS + 2 if positive else -CITY_RADIUS - 2
+    return 1 if positive else 0
+
+
+def test_station_halves_match_original_decision_tree():
+    for state in range(32):
+        city1_parity, city2_parity = state >> 4 & 1, state >> 3 & 1
+        dx_positive, dy_positive, far_apart = bool(state >> 2 & 1), bool(state >> 1 & 1), bool(state & 1)
+        # far apart is measured along the axis of city1
+        dx = _offset(dx_positive, far_apart and city1_parity == 0)
+        dy = _offset(dy_positive, far_apart and city1_parity == 1)
+        for city1_orientation in (city1_parity, city1_parity + 2):
+            for city2_orientation in (city2_parity, city2_parity + 2):
+                expected = _original_station_halves(city1_orientation, city2_orientation, dx, dy, CITY_RADIUS)
+                assert tuple(_STATION_HALVES[state].astype(bool)) == expected, state
+
+                # one station per half and no offset within it: the indices are the upper half flags
+                agent_start_idx, agent_target_idx, next_agent_start_idx, next_agent_target_idx = \
+                    _choose_station_indices(np.array([city1_orientation]), np.array([city2_orientation]),
+                                            np.array([dx]), np.array([dy]), np.array([1]), np.array([1]),
+                                            CITY_RADIUS, np.zeros((1, 4)))
+                assert (agent_start_idx[0], next_agent_target_idx[0], agent_target_idx[0],
+                        next_agent_start_idx[0]) == expected, state
@@ -0,0 +1,41 @@
+import numpy as np
+
+from flatland1.envs.malfunction_generators import _duration_params, _sample_num_broken_steps
+
+# expected delays of the departure and running time extensions of ParamMalfunctionGen and of TestMalfunctionGen
+EXPECTED_DELAYS = [0.2, 0.5, 1, 1.3, 2, 5]
+
+
+def _original_cum_prob_array(expected_delay):
+    """ The cumulative probabilities of the durations 1 to 50 the generators computed before _sample_num_broken_steps
+    """
+    param = 1/(10*expected_delay)
+    possible_delay_array = np.arange(1, 51)
+    cum_prob_array = np.empty(50)
+    for i in range(50):
+        cum_prob_array[i] = (1 - np.exp(-param*possible_delay_array[i]))/(1-np.exp(-param*possible_delay_array[49]))
+    return cum_prob_array
+
+
+def _original_num_broken_steps(cum_prob_array, random_number):
+    """ The scan over the cumulative probabilities the generators used before _sample_num_broken_steps """
+    # have a minimum malfunction duration of 2, because a duration of 1 messes up the trajectories
+    num_broken_steps = 2
+    for i in range(49):
+        if cum_prob_array[i] < random_number < cum_prob_array[i + 1]:
+            num_broken_steps = i+2
+            break
+    return num_broken_steps
+
+
+def test_sample_num_broken_steps_matches_original_scan():
+    # the long durations of small expected delays only occur for random numbers very close to 1
+    random_numbers = np.concatenate((np.linspace(0, 1, 20001)[:-1], 1 - np.logspace(-4, -14, 201)))
+    for expected_delay in EXPECTED_DELAYS:
+        param, truncated_mass = _duration_params(expected_delay)
+        sampled = [_sample_num_broken_steps(param, truncated_mass, u) for u in random_numbers]
+        cum_prob_array = _original_cum_prob_array(expected_delay)
+        original = [_original_num_broken_steps(cum_prob_array, u) for u in random_numbers]
+        assert sampled == original, expected_delay
+        # the floor of 2 and the longest duration of 50 both occur
+        assert min(sampled) == 2 and max(sampled) == 50
@@ -0,0 +1,34 @@
+from flatland1.envs.rail_generators import SparseRailGen
+
+
+def _cluster(row, col):
+    """ Three cities close to each other, closer than to any city of another cluster """
+    return [(row, col), (row, col + 10), (row + 10, col)]
+
+
+def test_contains_cliques_connected_cities():
+    rail_generator = SparseRailGen(max_num_cities=8)
+    # every city reaches the next ones along the line through its two closest neighbours
+    line = [(0, 10 * i) for i in range(6)]
+    assert not rail_generator.contains_cliques(line)
+    grid = [(20 * row, 20 * col) for row in range(3) for col in range(3)]
+    assert not rail_generator.contains_cliques(grid)
+
+
+def test_contains_cliques_disconnected_cities():
+    rail_generator = SparseRailGen(max_num_cities=8)
+    # two groups of 3 cities without a link between them
+    assert rail_generator.contains_cliques(_cluster(0, 0) + _cluster(100, 100))
+    # a group of 4 cities without a link to the rest
+    assert rail_generator.contains_cliques(_cluster(0, 0) + [(10, 10)] + [(100, 10 * i) for i in range(5)])
+    # a single isolated group of 3 is enough
+    assert rail_generator.contains_cliques([(0, 10 * i) for i in range(5)] + _cluster(100, 100))
+
+
+def test_contains_cliques_few_cities():
+    rail_generator = SparseRailGen(max_num_cities=8)
+    # the two closest neighbours of a city are all the other cities, no group is cut off
+    assert not rail_generator.contains_cliques([(0, 0), (100, 100)])
+    assert not rail_generator.contains_cliques([(0, 0), (0, 10), (100, 100)])
+    # with 4 cities a group without links leading out of it would have to be all of them
+    assert not rail_generator.contains_cliques([(0, 0), (0, 10), (100, 100), (100, 110)])